@@ -0,0 +1,77 @@
+"""Microbenchmark of the HLS playlist rewriter on large VOD playlists
+
+Compares `HLSRewriter` with the previous per-line regex implementation, which only
+rewrote absolute segment urls.
+
+Usage: python -m benchmarks.hls_rewriter [--segments 1000 10000 50000] [--repeat 5]
+"""
+
+from urllib.parse import urlencode
+import argparse
+import timeit
+import re
+
+from src.app.proxy.hls import HLSRewriter
+
+PLAYLIST_URL = "https://cdn.example.com/vod/movie/1080p/index.m3u8?token=abc123"
+
+
+def make_media_playlist(segment_count: int, absolute: bool) -> str:
+    base = "https://cdn.example.com/vod/movie/1080p/" if absolute else ""
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        "#EXT-X-TARGETDURATION:6",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        f'#EXT-X-MAP:URI="{base}init.mp4"',
+        f'#EXT-X-KEY:METHOD=AES-128,URI="{base}key.bin",IV=0x00000000000000000000000000000001',
+    ]
+    for i in range(segment_count):
+        lines.append("#EXTINF:6.006,")
+        lines.append(f"{base}segment_{i:05d}.m4s?token=abc123")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines)
+
+
+def legacy_rewrite(m3u8_content: str, headers: dict | None = None):
+    """The rewriter used before `HLSRewriter`, kept only for comparison"""
+    if headers is None:
+        headers = {}
+
+    lines = m3u8_content.split("\n")
+    for i, line in enumerate(lines):
+        url_matches = re.match(r"https?://[a-zA-Z0-9.-]+(?:\.[a-zA-Z]{2,})(:\d+)?(/[^\s]*)?", line)
+        if url_matches:
+            url = url_matches[0]
+            query = urlencode({"url": url, "headers": headers})
+            lines[i] = f"?{query}"
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    headers = {"Referer": "https://example.com/"}
+    print(f"{'segments':>10} {'playlist':>10} {'legacy':>12} {'rewriter':>12} {'per segment':>12}")
+    for segment_count in args.segments:
+        for absolute in (True, False):
+            content = make_media_playlist(segment_count, absolute)
+
+            legacy_time = min(timeit.repeat(lambda: legacy_rewrite(content, headers), number=1, repeat=args.repeat))
+            rewriter_time = min(
+                timeit.repeat(lambda: HLSRewriter(PLAYLIST_URL, headers).rewrite(content), number=1, repeat=args.repeat)
+            )
+
+            kind = "absolute" if absolute else "relative"
+            print(
+                f"{segment_count:>10} {kind:>10} {legacy_time * 1000:>10.2f}ms {rewriter_time * 1000:>10.2f}ms "
+                f"{rewriter_time / segment_count * 1e6:>10.2f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
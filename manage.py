@@ -36,25 +36,29 @@ def runserver(protocol: str, address: str, disable_cache: bool):
             )
 
 
-async def clearcache():
-    from sqlalchemy import select
-
+def clearcache(host: str | None, older_than: str | None, content_type: str | None):
+    # imported outside of the event loop, since some modules run their own loop on import
     from src.app.proxy.services import CacheMetaService
-    from src.app.proxy.models import CacheMeta
-    from src.app.db import SessionLocal
+    from src.app.db import SessionLocal, init_db
+
+    async def run():
+        await init_db()
+        async with SessionLocal() as db:
+            print(await CacheMetaService(db).purge(host, older_than, content_type))
+
+    asyncio.run(run())
 
-    async with SessionLocal() as db:
-        stmt = select(CacheMeta)
-        results = await db.execute(stmt)
-        results = [instance.id for instance in results.scalars().all()]
 
-        cache_meta_service = CacheMetaService(db)
+def reconcilecache():
+    # imported outside of the event loop, since some modules run their own loop on import
+    from src.app.db import init_db
+    from src.app.proxy.reconcile import reconcile_cache
 
-        tasks = []
-        for id in results:
-            tasks.append(cache_meta_service.delete(id))
+    async def run():
+        await init_db()
+        print(await reconcile_cache())
 
-        await asyncio.gather(*tasks)
+    asyncio.run(run())
 
 
 def main():
@@ -93,7 +97,28 @@ def main():
     # arguments for clearing cached files
     clearcache_parser = subparsers.add_parser(
         "clearcache",
-        help="Clears all cached files from the disk and database.",
+        help="Clears all cached files from the disk and database, or only the ones matching the filters.",
+    )
+    clearcache_parser.add_argument(
+        "--host",
+        type=str,
+        help="Only clear files from this host.",
+    )
+    clearcache_parser.add_argument(
+        "--older-than",
+        type=str,
+        help="Only clear files cached longer ago than this (e.g.: '7d', '12h').",
+    )
+    clearcache_parser.add_argument(
+        "--content-type",
+        type=str,
+        help="Only clear files whose content type starts with this (e.g.: 'image/').",
+    )
+
+    # arguments for reconciling the cache
+    reconcilecache_parser = subparsers.add_parser(
+        "reconcilecache",
+        help="Fixes cache records and files left inconsistent by a crash. Should be run while the server is stopped.",
     )
 
     # parse args and run command
@@ -117,7 +142,10 @@ def main():
             runserver(protocol, address, disable_cache)
 
         case "clearcache":
-            asyncio.run(clearcache())
+            clearcache(args.host, args.older_than, args.content_type)
+
+        case "reconcilecache":
+            reconcilecache()
 
 
 if __name__ == "__main__":
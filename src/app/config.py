@@ -1,5 +1,10 @@
+import os
+
 # address in which the server is running on this machine
 LOCAL_ADDRESS = None
 
 # url for comunicating with the internal cache proxy
 CACHE_URL = None
+
+# token required by admin endpoints, which only accept local requests if it's not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
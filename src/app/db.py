@@ -1,3 +1,4 @@
+from sqlalchemy import Connection, inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 
@@ -12,6 +13,28 @@ class Base(DeclarativeBase):
     pass
 
 
+def add_missing_columns(conn: Connection):
+    """Adds the columns declared on the models that are missing from already existing tables
+
+    `create_all` only creates missing tables, so this keeps databases created by older versions usable.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = [column["name"] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+        # indexes of the new columns are also missing
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
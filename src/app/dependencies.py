@@ -1,8 +1,11 @@
 from typing import AsyncGenerator
 
+from fastapi import Request
+from fastapi.exceptions import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from .db import SessionLocal
+from . import config
 
 
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
@@ -11,3 +14,13 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
         yield db
     finally:
         await db.close()
+
+
+async def require_admin(request: Request):
+    """Only lets requests with the admin token through, or local requests if there's no token"""
+    if config.ADMIN_TOKEN is not None:
+        if request.headers.get("x-admin-token") != config.ADMIN_TOKEN:
+            raise HTTPException(status_code=403, detail="Invalid admin token")
+
+    elif request.client is None or request.client.host not in ("127.0.0.1", "::1", "localhost"):
+        raise HTTPException(status_code=403, detail="Admin endpoints only accept local requests")
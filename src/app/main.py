@@ -7,14 +7,26 @@ from fastapi.middleware.cors import CORSMiddleware
 from . import website, proxy, stremio, info
 from .db import init_db
 from .proxy.tasks import repeat_tasks
+from .proxy.services import stream_client
+from .proxy.access import access_tracker
+from .proxy.constants import CACHE_ACCESS_FLUSH_INTERVAL
+from .proxy.reconcile import reconcile_cache
+from ..utils.http_client import shared_client
 
 
 # TODO: think of a more scalable way to run repeated tasks from any app
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    print(f"Cache reconciled: {await reconcile_cache()}")
+    await stream_client.start()
+    await shared_client.start()
     asyncio.create_task(repeat_tasks(30))
+    asyncio.create_task(access_tracker.run(CACHE_ACCESS_FLUSH_INTERVAL))
     yield
+    await access_tracker.flush()
+    await stream_client.close()
+    await shared_client.close()
 
 
 app = FastAPI(lifespan=lifespan, debug=True)
@@ -0,0 +1,97 @@
+from datetime import datetime
+import asyncio
+
+from sqlalchemy import update, bindparam, func
+
+from ..db import SessionLocal
+from .models import CacheMeta
+from .constants import CACHE_ACCESS_FLUSH_THRESHOLD
+
+
+class AccessTracker:
+    """Keeps the accesses to cached files in memory and writes them to the database in batches.
+
+    Cache hits only call `touch`, so serving a cached file doesn't need any database write.
+    The pending values are flushed with a single batched UPDATE every few seconds, or as soon
+    as `flush_threshold` hits are pending.
+    """
+
+    def __init__(self, flush_threshold: int = 100):
+        self.flush_threshold = flush_threshold
+        self._last_used_at: dict[str, datetime] = {}
+        self._hits: dict[str, int] = {}
+        self._pending_hits = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+    def touch(self, hash: str):
+        """Registers an access to the cached file of `hash`"""
+        self._last_used_at[hash] = datetime.now()
+        self._hits[hash] = self._hits.get(hash, 0) + 1
+        self._pending_hits += 1
+
+        # flush early if too many accesses are pending
+        if self._pending_hits >= self.flush_threshold and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def get_last_used_at(self, hash: str) -> datetime | None:
+        """Returns the time of the last access not yet written to the database"""
+        return self._last_used_at.get(hash)
+
+    def get_pending_hits(self, hash: str) -> int:
+        """Returns the number of hits not yet written to the database"""
+        return self._hits.get(hash, 0)
+
+    def forget(self, hash: str):
+        """Drops the pending accesses of a deleted record"""
+        self._pending_hits -= self._hits.pop(hash, 0)
+        self._last_used_at.pop(hash, None)
+
+    async def flush(self):
+        """Writes every pending access to the database in a single batch"""
+        async with self._flush_lock:
+            if not self._last_used_at:
+                return
+
+            # swap the pending values so new accesses can keep being registered during the flush
+            last_used_at, self._last_used_at = self._last_used_at, {}
+            hits, self._hits = self._hits, {}
+            self._pending_hits = 0
+
+            params = [
+                {"b_id": hash, "b_last_used_at": last_used_at[hash], "b_hits": hits.get(hash, 0)}
+                for hash in last_used_at.keys()
+            ]
+            stmt = (
+                update(CacheMeta)
+                .where(CacheMeta.id == bindparam("b_id"))
+                .values(
+                    last_used_at=bindparam("b_last_used_at"),
+                    hit_count=func.coalesce(CacheMeta.hit_count, 0) + bindparam("b_hits"),
+                )
+            )
+
+            try:
+                # run it on the connection so it's sent as a single executemany
+                async with SessionLocal() as db:
+                    connection = await db.connection()
+                    await connection.execute(stmt, params)
+                    await db.commit()
+
+            except Exception as e:
+                print(f"Error flushing cache accesses: {e}")
+
+                # put the values back so they're written on the next flush
+                for hash in last_used_at.keys():
+                    self._last_used_at.setdefault(hash, last_used_at[hash])
+                    self._hits[hash] = self._hits.get(hash, 0) + hits.get(hash, 0)
+                    self._pending_hits += hits.get(hash, 0)
+
+    async def run(self, delay: float):
+        """Flushes the pending accesses every `delay` seconds"""
+        while True:
+            await asyncio.sleep(delay)
+            await self.flush()
+
+
+access_tracker = AccessTracker(CACHE_ACCESS_FLUSH_THRESHOLD)
@@ -0,0 +1,78 @@
+from collections import deque
+import asyncio
+
+
+class StreamBuffer:
+    """Byte-budgeted queue of chunks between the task reading a stream from the upstream and the client response.
+
+    The reader waits while more than `max_size` bytes are buffered, so a slow client keeps the memory used
+    by its stream bounded, while a fast one never has to wait for the next upstream read.
+    """
+
+    def __init__(self, max_size: int, chunks: list[bytes] | None = None):
+        self.max_size = max_size
+        self.is_closed = False
+        self.error: Exception | None = None
+
+        self._chunks: deque[bytes] = deque(chunks or ())
+        self.size = sum(map(len, self._chunks))
+        self._condition = asyncio.Condition()
+
+    async def put(self, chunk: bytes) -> bool:
+        """Waits for room on the buffer and adds a chunk to it. Returns False if the buffer has been closed"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.size < self.max_size or self.is_closed)
+            if self.is_closed:
+                return False
+
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+            self._condition.notify_all()
+            return True
+
+    async def try_put(self, chunk: bytes) -> bool:
+        """Adds a chunk without waiting. Returns False if the buffer is full or has been closed"""
+        async with self._condition:
+            if self.is_closed or self.size >= self.max_size:
+                return False
+
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+            self._condition.notify_all()
+            return True
+
+    async def get(self, max_size: int) -> bytes | None:
+        """Waits for data and returns up to `max_size` bytes of the buffered chunks joined together
+
+        Returns None once the buffer is closed and empty, or raises the error it was closed with.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._chunks or self.is_closed)
+
+            # join as many chunks as possible, so the chunks sent grow when the client falls behind
+            chunks = []
+            size = 0
+            while self._chunks and (not chunks or size + len(self._chunks[0]) <= max_size):
+                chunk = self._chunks.popleft()
+                chunks.append(chunk)
+                size += len(chunk)
+
+            if chunks:
+                self.size -= size
+                self._condition.notify_all()
+                return b"".join(chunks)
+
+        if self.error is not None:
+            raise self.error
+
+        return None
+
+    async def close(self, error: Exception | None = None):
+        """Stops accepting chunks. The buffered ones can still be read, unless the buffer is closed with an error"""
+        async with self._condition:
+            self.is_closed = True
+            self.error = error
+            if error is not None:
+                self._chunks.clear()
+                self.size = 0
+            self._condition.notify_all()
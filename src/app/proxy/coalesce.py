@@ -0,0 +1,204 @@
+from contextlib import aclosing
+from typing import Awaitable, Callable
+import asyncio
+
+import aiohttp
+from fastapi import Request
+
+from .buffers import StreamBuffer
+from .utils import iter_upstream, yield_chunks, handle_stream_errors
+from .constants import (
+    STREAM_BUFFER_SIZE,
+    STREAM_MAX_CHUNK_SIZE,
+    STREAM_DISCONNECT_CHECK_INTERVAL,
+    STREAM_COALESCE_REPLAY_SIZE,
+)
+
+
+class StreamSubscriber:
+    """A client of a shared stream, with its own buffer so it can't hold back the other clients"""
+
+    def __init__(self, stream: "SharedStream", buffer: StreamBuffer, offset: int):
+        self.stream = stream
+        self.buffer = buffer
+        self.offset = offset  # bytes put on the buffer so far
+        self.is_detached = False
+
+
+class SharedStream:
+    """A single upstream response broadcast to every client that requested the same stream.
+
+    While there's a single client, the host is read at its pace. Once there are more, clients that fall more than
+    a buffer behind are detached and continue on their own connection to the host, from the first byte they haven't
+    received. The first `STREAM_COALESCE_REPLAY_SIZE` bytes are kept, so clients
+    can still join while the stream is starting.
+    """
+
+    def __init__(self, coalescer: "StreamCoalescer", key: str):
+        self.coalescer = coalescer
+        self.key = key
+        self.response: aiohttp.ClientResponse | None = None
+        self.reopen: Callable[[int], Awaitable[aiohttp.ClientResponse]] | None = None
+        self.subscribers: set[StreamSubscriber] = set()
+        self.offset = 0
+        self.is_joinable = True
+
+        self._head: list[bytes] = []
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(
+        self,
+        response: aiohttp.ClientResponse,
+        reopen: Callable[[int], Awaitable[aiohttp.ClientResponse]],
+    ) -> StreamSubscriber:
+        """Starts broadcasting the response and returns the subscriber of the client that requested it"""
+        self.response = response
+        self.reopen = reopen
+        subscriber = self._add_subscriber()
+        self._task = asyncio.create_task(self._read())
+        self._ready.set()
+        return subscriber
+
+    def abort(self):
+        """Lets the clients waiting for the stream know it won't be shared"""
+        self._close_joining()
+        self._ready.set()
+
+    async def subscribe(self) -> StreamSubscriber | None:
+        """Waits for the stream to start and joins it. Returns None if it can't be joined anymore"""
+        await self._ready.wait()
+        if not self.is_joinable:
+            return None
+
+        return self._add_subscriber()
+
+    def unsubscribe(self, subscriber: StreamSubscriber):
+        self.subscribers.discard(subscriber)
+
+        # stop reading from the host once nobody is listening
+        if not self.subscribers and self._task is not None:
+            self._close_joining()
+            self._task.cancel()
+
+    def _add_subscriber(self) -> StreamSubscriber:
+        # replay the start of the stream to clients joining late
+        subscriber = StreamSubscriber(self, StreamBuffer(STREAM_BUFFER_SIZE, self._head), self.offset)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def _close_joining(self):
+        self.is_joinable = False
+        self._head = []
+        self.coalescer.remove(self)
+
+    async def _detach(self, subscriber: StreamSubscriber):
+        subscriber.is_detached = True
+        self.subscribers.discard(subscriber)
+        await subscriber.buffer.close()
+
+    async def _read(self):
+        try:
+            async with aclosing(iter_upstream(self.response, self.reopen)) as chunks:
+                async for chunk in chunks:
+                    self.offset += len(chunk)
+                    if self.is_joinable:
+                        self._head.append(chunk)
+                        if self.offset > STREAM_COALESCE_REPLAY_SIZE:
+                            self._close_joining()
+
+                    # a single client sets the pace of the stream, like a stream that isn't shared
+                    # its buffer can't fill up while others can still join, since the replayed start is smaller
+                    if len(self.subscribers) == 1:
+                        subscriber = next(iter(self.subscribers))
+                        if await subscriber.buffer.put(chunk):
+                            subscriber.offset += len(chunk)
+
+                    # with more clients, the ones that fell behind continue on their own instead of holding back the others
+                    else:
+                        for subscriber in list(self.subscribers):
+                            if await subscriber.buffer.try_put(chunk):
+                                subscriber.offset += len(chunk)
+                            elif not subscriber.buffer.is_closed:
+                                await self._detach(subscriber)
+
+                    if not self.subscribers:
+                        return
+
+            for subscriber in list(self.subscribers):
+                await subscriber.buffer.close()
+
+        except Exception as e:
+            for subscriber in list(self.subscribers):
+                await subscriber.buffer.close(e)
+
+        # cleanup
+        finally:
+            self._close_joining()
+
+
+class StreamCoalescer:
+    """Keeps track of the streams that can still be joined, keyed by their url, headers and range"""
+
+    def __init__(self):
+        self._streams: dict[str, SharedStream] = {}
+
+    def get(self, key: str) -> SharedStream | None:
+        return self._streams.get(key)
+
+    def create(self, key: str) -> SharedStream:
+        """Registers a stream before its response arrives, so identical requests made meanwhile can wait for it"""
+        stream = SharedStream(self, key)
+        self._streams[key] = stream
+        return stream
+
+    def remove(self, stream: SharedStream):
+        if self._streams.get(stream.key) is stream:
+            del self._streams[stream.key]
+
+    def to_json(self):
+        return {
+            "stream_count": len(self._streams),
+            "subscriber_count": sum(len(stream.subscribers) for stream in self._streams.values()),
+        }
+
+
+async def yield_shared_chunks(request: Request, subscriber: StreamSubscriber, chunk_size: int = STREAM_MAX_CHUNK_SIZE):
+    """Yields the chunks a subscriber receives for a `StreamingResponse`, like `yield_chunks` does for a response
+
+    If the subscriber is detached for falling behind, the rest of the stream is requested from the host
+    and streamed with `yield_chunks` instead.
+    """
+    stream = subscriber.stream
+
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(STREAM_DISCONNECT_CHECK_INTERVAL)
+
+        await subscriber.buffer.close()
+
+    watcher_task = asyncio.create_task(watch_disconnect())
+
+    # send the buffered content to the client
+    try:
+        async with handle_stream_errors():
+            while (chunk := await subscriber.buffer.get(chunk_size)) is not None:
+                yield chunk
+
+            if subscriber.is_detached:
+                watcher_task.cancel()
+                offset = subscriber.offset
+
+                async def reopen(resume_offset: int) -> aiohttp.ClientResponse:
+                    return await stream.reopen(offset + resume_offset)
+
+                async for chunk in yield_chunks(request, await reopen(0), chunk_size, reopen):
+                    yield chunk
+
+    # stop reading from the host if every client is gone
+    finally:
+        watcher_task.cancel()
+        stream.unsubscribe(subscriber)
+
+
+stream_coalescer = StreamCoalescer()
@@ -23,13 +23,109 @@ ALLOWED_REGEXS = [
 ]
 
 
+# lowercase media types of hls playlists, only rewritten if they start with "#EXTM3U"
 HLS_CONTENT_TYPE_HEADERS = [
-    "application/vnd.apple.mpegURL",
-    "application/x-mpegURL",
+    "application/vnd.apple.mpegurl",
+    "application/x-mpegurl",
     "audio/mpegurl",
     "audio/x-mpegurl",
     "text/plain",
 ]
 
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
+CACHE_SHARD_LENGTH = 2  # number of hash characters used to name the subdirectory of each cached file
 MAX_CACHE_DIR_SIZE = 200 * 1024 * 1024  # 200 megabytes
+CACHE_CHUNK_SIZE = 64 * 1024  # size of the chunks written to (and streamed from) a cache file
+CACHE_MAX_ENTRY_SIZE = 50 * 1024 * 1024  # bigger responses are relayed without being cached
+CACHE_UNCACHEABLE_TTL = 60 * 60  # seconds a response too big to be cached is relayed without trying again
+
+# how long error responses are cached and replayed, by status code or status class
+# errors without a matching key are not cached
+CACHE_NEGATIVE_TTLS = {
+    "404": "1h",
+    "410": "1h",
+    "4xx": "5m",
+    "5xx": "30s",
+}
+
+# request headers that don't change the upstream response, so they're left out of the cache key
+CACHE_KEY_IGNORED_HEADERS = [
+    "accept-encoding",
+    "cache-control",
+    "connection",
+    "if-modified-since",
+    "if-none-match",
+    "keep-alive",
+    "pragma",
+    "te",
+    "upgrade-insecure-requests",
+]
+
+# text-like responses are stored gzipped on the disk
+CACHE_COMPRESSED_CONTENT_TYPES = [
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/xhtml+xml",
+    "application/vnd.apple.mpegurl",
+    "application/x-mpegurl",
+    "image/svg+xml",
+]
+CACHE_COMPRESSION_LEVEL = 6
+CACHE_COMPRESSION_MIN_SIZE = 1024  # smaller files are not worth compressing
+
+# accesses to cached files are written to the database in batches
+CACHE_ACCESS_FLUSH_INTERVAL = 5  # seconds
+CACHE_ACCESS_FLUSH_THRESHOLD = 100  # pending hits that trigger an early flush
+
+# in-memory tier kept in front of the disk cache for small files
+HOT_CACHE_MAX_SIZE = 32 * 1024 * 1024  # 32 megabytes
+HOT_CACHE_MAX_ENTRY_SIZE = 256 * 1024  # 256 kilobytes
+
+# eviction of cached files
+CACHE_EVICTION_POLICY = "gdsf"  # one of "lru", "lfu" or "gdsf"
+CACHE_LOW_WATERMARK = 0.8  # once a limit is reached, files are evicted until this fraction of it is used
+
+# optional size limits for cached files whose content type starts with each key
+# e.g.: {"image/": 100 * 1024 * 1024, "text/html": 50 * 1024 * 1024}
+CACHE_CONTENT_TYPE_QUOTAS: dict[str, int] = {}
+
+# connection pool used by the stream proxy
+STREAM_CONNECTION_LIMIT = 100
+STREAM_CONNECTION_LIMIT_PER_HOST = 16
+STREAM_KEEPALIVE_TIMEOUT = 30  # seconds an idle upstream connection is kept open
+STREAM_DNS_CACHE_TTL = 300  # seconds
+STREAM_BUFFER_SIZE = 4 * 1024 * 1024  # bytes read ahead from the host for each stream
+STREAM_MAX_CHUNK_SIZE = 256 * 1024  # biggest chunk sent to the client at once
+STREAM_DISCONNECT_CHECK_INTERVAL = 1  # seconds
+
+# streams interrupted by upstream errors are resumed from the last byte sent
+STREAM_RESUME_MAX_RETRIES = 3  # consecutive attempts before giving up
+STREAM_RESUME_RETRY_DELAY = 0.5  # seconds, multiplied by the number of the attempt
+
+# identical streams requested at the same time share a single connection to the host
+STREAM_COALESCE_REPLAY_SIZE = 1024 * 1024  # bytes kept from the start of shared streams for clients joining late
+
+# size, type and final url after the redirects of each stream, used to answer HEAD requests and skip the redirects
+STREAM_METADATA_TTL = 5 * 60  # seconds
+STREAM_METADATA_MAX_ENTRIES = 1000
+
+# the first and last bytes of progressive streams are kept in memory to answer the probes players make before playing
+RANGE_CACHE_CONTENT_TYPES = [
+    "video/mp4",
+    "video/quicktime",
+    "video/x-m4v",
+    "video/x-matroska",
+    "video/webm",
+]
+RANGE_CACHE_HEAD_SIZE = 4 * 1024 * 1024  # bytes kept from the start of each stream
+RANGE_CACHE_TAIL_SIZE = 4 * 1024 * 1024  # bytes kept from the end of each stream, where the index of most files is
+RANGE_CACHE_MAX_SIZE = 128 * 1024 * 1024  # bytes kept for all streams
+RANGE_CACHE_TTL = 10 * 60  # seconds a stream is kept after it was last requested
+
+# upcoming segments of HLS streams are downloaded into memory while the current one plays
+HLS_PREFETCH_SEGMENTS = 3  # segments fetched ahead of the one requested
+HLS_PREFETCH_MAX_SIZE = 64 * 1024 * 1024  # bytes of prefetched segments kept in memory
+HLS_PREFETCH_MAX_SEGMENT_SIZE = 16 * 1024 * 1024  # bigger segments are streamed instead
+HLS_PREFETCH_SESSION_TTL = 60  # seconds a playlist is kept after its last segment request
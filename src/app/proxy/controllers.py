@@ -3,8 +3,8 @@ import ast
 from fastapi import APIRouter, Request, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .views import stream_proxy, cache_proxy
-from ..dependencies import get_db
+from .views import stream_proxy, stream_proxy_head, cache_proxy, clear_cache, cache_stats_overview
+from ..dependencies import get_db, require_admin
 
 router = APIRouter(prefix="/proxy")
 
@@ -23,12 +23,49 @@ async def stream_proxy_route(request: Request, url: str, headers: None | str = N
     return await stream_proxy(request, url, headers, request_headers)
 
 
+@router.head("/stream/")
+async def stream_proxy_head_route(url: str, headers: None | str = None):
+    # create headers dict that will be used on the request to the host
+    if headers is not None:
+        headers = ast.literal_eval(headers)
+    else:
+        headers = {}
+
+    return await stream_proxy_head(url, headers)
+
+
 @router.get("/cache/")
-async def cache_proxy_route(request: Request, url: str, headers: str | None = None, expires: str | None = None, db: AsyncSession = Depends(get_db)):
+async def cache_proxy_route(
+    request: Request,
+    url: str,
+    headers: str | None = None,
+    expires: str | None = None,
+    stale_while_revalidate: str | None = None,
+    stale_if_error: str | None = None,
+    db: AsyncSession = Depends(get_db),
+):
     # create headers dict that will be used on the request to the host
     if headers is not None:
         headers = ast.literal_eval(headers)
     else:
         headers = {}
 
-    return await cache_proxy(url, headers, expires, db)
+    # turn request headers into a dict
+    request_headers = {key.lower(): request.headers.get(key) for key in request.headers.keys()}
+
+    return await cache_proxy(request, url, headers, expires, stale_while_revalidate, stale_if_error, request_headers, db)
+
+
+@router.delete("/cache/", dependencies=[Depends(require_admin)])
+async def clear_cache_route(
+    host: str | None = None,
+    older_than: str | None = None,
+    content_type: str | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    return await clear_cache(host, older_than, content_type, db)
+
+
+@router.get("/stats/", dependencies=[Depends(require_admin)])
+async def cache_stats_route(top: int = 10, db: AsyncSession = Depends(get_db)):
+    return await cache_stats_overview(top, db)
@@ -0,0 +1,124 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+import bisect
+
+from .models import CacheMeta
+from .access import access_tracker
+
+
+class EvictionPolicy(ABC):
+    """Decides which cache entries are evicted first when the cache grows past its limits.
+
+    Entries with the lowest priority are evicted first.
+    """
+
+    name = ""
+
+    @abstractmethod
+    def priority(self, cache_meta: CacheMeta) -> tuple:
+        pass
+
+    def sort(self, entries: list[CacheMeta]) -> list[CacheMeta]:
+        """Returns the entries in the order they should be evicted"""
+        return sorted(entries, key=self.priority)
+
+    def on_evict(self, entries: list[CacheMeta]):
+        """Called with the entries picked for eviction, before they are deleted"""
+        pass
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evicts the least recently used entries first"""
+
+    name = "lru"
+
+    def priority(self, cache_meta: CacheMeta) -> tuple:
+        return (get_last_used_timestamp(cache_meta),)
+
+
+class LFUPolicy(EvictionPolicy):
+    """Evicts the least frequently used entries first, breaking ties by recency"""
+
+    name = "lfu"
+
+    def priority(self, cache_meta: CacheMeta) -> tuple:
+        return (get_frequency(cache_meta), get_last_used_timestamp(cache_meta))
+
+
+class GDSFPolicy(EvictionPolicy):
+    """Greedy-Dual-Size-Frequency: evicts entries with the lowest `L + frequency / size` first.
+
+    `L` is an inflation value raised to the priority of the last evicted entry on every run,
+    so entries that stopped being used age out even if they were popular before. Each entry is
+    scored with the inflation value in effect at the time it was last used. Favoring small and
+    hot entries keeps large one-off files from pushing many small pages and images out.
+    """
+
+    name = "gdsf"
+
+    def __init__(self, max_history: int = 1024):
+        self.inflation = 0.0
+        self._max_history = max_history
+        self._history_timestamps: list[float] = [0.0]
+        self._history_values: list[float] = [0.0]
+
+    def _inflation_at(self, timestamp: float) -> float:
+        index = bisect.bisect_right(self._history_timestamps, timestamp) - 1
+        return self._history_values[max(index, 0)]
+
+    def priority(self, cache_meta: CacheMeta) -> tuple:
+        last_used = get_last_used_timestamp(cache_meta)
+        size = max(cache_meta.cache_size or 0, 1)
+        return (self._inflation_at(last_used) + get_frequency(cache_meta) / size, last_used)
+
+    def on_evict(self, entries: list[CacheMeta]):
+        if not entries:
+            return
+
+        # raise the inflation value to the highest priority evicted
+        self.inflation = max(self.inflation, *(self.priority(cache_meta)[0] for cache_meta in entries))
+        self._history_timestamps.append(datetime.now().timestamp())
+        self._history_values.append(self.inflation)
+
+        # forget the oldest values
+        if len(self._history_timestamps) > self._max_history:
+            del self._history_timestamps[0]
+            del self._history_values[0]
+
+
+EVICTION_POLICIES: dict[str, type[EvictionPolicy]] = {
+    LRUPolicy.name: LRUPolicy,
+    LFUPolicy.name: LFUPolicy,
+    GDSFPolicy.name: GDSFPolicy,
+}
+
+
+def get_eviction_policy(name: str) -> EvictionPolicy:
+    try:
+        return EVICTION_POLICIES[name.lower()]()
+    except KeyError:
+        msg = f"Invalid eviction policy. Got '{name}', expected any of the following: {list(EVICTION_POLICIES.keys())}"
+        raise ValueError(msg)
+
+
+def get_quota_key(content_type: str | None, quotas: dict[str, int]) -> str | None:
+    """Returns the longest key of `quotas` that prefixes `content_type`, if any"""
+    if content_type is None:
+        return None
+
+    matches = [key for key in quotas.keys() if content_type.startswith(key)]
+    if not matches:
+        return None
+
+    return max(matches, key=len)
+
+
+def get_last_used_timestamp(cache_meta: CacheMeta) -> float:
+    # accesses not yet written to the database take precedence
+    last_used_at = access_tracker.get_last_used_at(cache_meta.id) or cache_meta.last_used_at or cache_meta.created_at
+    return last_used_at.timestamp()
+
+
+def get_frequency(cache_meta: CacheMeta) -> int:
+    # the request that created the entry also counts as an use
+    return (cache_meta.hit_count or 0) + access_tracker.get_pending_hits(cache_meta.id) + 1
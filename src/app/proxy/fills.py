@@ -0,0 +1,92 @@
+import asyncio
+
+
+class CacheFill:
+    """Tracks a cache file that is still being downloaded.
+
+    The downloader appends bytes to the file and reports its progress here, while any number
+    of readers stream the growing file, so nobody has to wait for the download to finish.
+    """
+
+    def __init__(self, hash: str, path: str):
+        self.hash = hash
+        self.path = path
+
+        self.status: int | None = None
+        self.headers: dict | None = None
+        self.size = 0
+        self.is_finished = False
+        self.error: Exception | None = None
+
+        self._condition = asyncio.Condition()
+
+    async def set_response(self, status: int, headers: dict):
+        """Saves the upstream status and headers and wakes the readers waiting for them"""
+        async with self._condition:
+            self.status = status
+            self.headers = headers
+            self._condition.notify_all()
+
+    async def append(self, size: int):
+        """Registers that `size` more bytes have been flushed to the file"""
+        async with self._condition:
+            self.size += size
+            self._condition.notify_all()
+
+    async def finish(self, error: Exception | None = None):
+        """Marks the download as completed, or as failed if `error` is given"""
+        async with self._condition:
+            self.is_finished = True
+            self.error = error
+            self._condition.notify_all()
+
+    async def wait_for_response(self):
+        """Waits until the upstream response headers are available
+
+        Raises the download error if it fails before any headers are received. Returns without
+        headers if the download finishes without a new file (e.g. the cached one is still valid).
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.headers is not None or self.is_finished)
+
+        if self.headers is None and self.error is not None:
+            raise self.error
+
+    def iter_chunks(self, chunk_size: int = 64 * 1024):
+        """Returns an iterator over the content of the file as it's written, until the download finishes
+
+        The file is opened right away, so it can still be read after the download publishes (moves) it.
+        """
+        file = open(self.path, "rb")
+        return self._iter_file(file, chunk_size)
+
+    async def _iter_file(self, file, chunk_size: int):
+        offset = 0
+        with file:
+            while True:
+                # wait for new data to be flushed to the file
+                async with self._condition:
+                    await self._condition.wait_for(lambda: self.size > offset or self.is_finished)
+                    available = self.size - offset
+                    is_finished = self.is_finished
+                    error = self.error
+
+                # read every byte written since the last iteration
+                while available > 0:
+                    chunk = await asyncio.to_thread(file.read, min(chunk_size, available))
+                    if not chunk:
+                        break
+
+                    offset += len(chunk)
+                    available -= len(chunk)
+                    yield chunk
+
+                # the bytes written before a failure are still sent
+                if is_finished:
+                    if error is not None:
+                        raise error
+                    break
+
+
+# fills currently running on this process
+active_fills: dict[str, CacheFill] = {}
@@ -0,0 +1,101 @@
+from urllib.parse import urlencode, urljoin, urlsplit, quote_plus
+import re
+
+import aiohttp
+
+# quoted URI attribute of tags like EXT-X-KEY, EXT-X-MAP, EXT-X-MEDIA and EXT-X-I-FRAME-STREAM-INF
+URI_ATTRIBUTE_REGEX = re.compile(r'URI="([^"]*)"')
+
+
+class HLSRewriter:
+    """Rewrites the URIs of a HLS playlist so they go through the stream proxy.
+
+    Works line by line in a single pass, so a playlist can be rewritten while it's streamed. Relative
+    URIs are resolved against the playlist url. Both media playlists (segments, keys and init sections)
+    and master playlists (variants, renditions and I-frame playlists) are handled. Content that doesn't
+    start with "#EXTM3U" is left untouched.
+
+    The absolute urls of the media segments are collected on `segment_urls`, in playlist order.
+    """
+
+    def __init__(self, playlist_url: str, headers: dict | None = None):
+        if headers is None:
+            headers = {}
+
+        self.playlist_url = playlist_url
+        self.is_playlist: bool | None = None
+        self.segment_urls: list[str] = []
+        self._is_segment_next = False
+
+        # the headers are the same for every URI, so they're only encoded once
+        self._headers_query = urlencode({"headers": headers})
+
+        # directory of the playlist, most relative URIs are plain file names that only need to be appended to it
+        parts = urlsplit(playlist_url)
+        self._base_url = f"{parts.scheme}://{parts.netloc}{parts.path.rsplit('/', 1)[0]}/"
+
+    def get_url(self, uri: str) -> str:
+        """Returns the absolute url of an URI of the playlist"""
+        uri = uri.strip()
+        if uri.startswith(("http://", "https://")):
+            return uri
+        elif uri and ":" not in uri and uri[0] not in "./":
+            return self._base_url + uri
+        else:
+            return urljoin(self.playlist_url, uri)
+
+    def get_proxy_uri(self, uri: str) -> str:
+        """Returns the stream proxy URI of an absolute or relative URI, relative to the playlist on the proxy"""
+        url = self.get_url(uri)
+
+        # inline data and DRM key URIs can't go through the proxy
+        if not url.startswith(("http://", "https://")):
+            return uri
+
+        return f"?url={quote_plus(url, safe='')}&{self._headers_query}"
+
+    def _replace_uri_attribute(self, match: re.Match) -> str:
+        return f'URI="{self.get_proxy_uri(match[1])}"'
+
+    def rewrite_line(self, line: str) -> str:
+        # only playlists are rewritten, which must start with the "#EXTM3U" tag
+        if self.is_playlist is None:
+            if not line.strip():
+                return line
+            self.is_playlist = line.lstrip("\ufeff").startswith("#EXTM3U")
+
+        if not self.is_playlist or not line or line.isspace():
+            return line
+
+        # "#EXTINF" tags precede the URI of a media segment
+        # other tags only need to be rewritten if they have an URI attribute
+        if line[0] == "#":
+            if line.startswith("#EXTINF"):
+                self._is_segment_next = True
+            elif 'URI="' in line:
+                return URI_ATTRIBUTE_REGEX.sub(self._replace_uri_attribute, line)
+            return line
+
+        # any other line is the URI of a segment or variant playlist
+        if self._is_segment_next:
+            self._is_segment_next = False
+            self.segment_urls.append(self.get_url(line))
+
+        return self.get_proxy_uri(line)
+
+    def rewrite(self, content: str) -> str:
+        return "\n".join(map(self.rewrite_line, content.split("\n")))
+
+
+async def iter_rewritten_playlist(response: aiohttp.ClientResponse, rewriter: HLSRewriter):
+    """Yields the lines of a playlist response rewritten as they're received, releasing the response at the end"""
+    encoding = response.charset or "utf-8"
+    try:
+        async for line in response.content:
+            line = line.decode(encoding, errors="replace")
+            newline = "\n" if line.endswith("\n") else ""
+            yield rewriter.rewrite_line(line.rstrip("\r\n")) + newline
+
+    # cleanup
+    finally:
+        response.release()
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from datetime import datetime
+
+from .constants import HOT_CACHE_MAX_SIZE, HOT_CACHE_MAX_ENTRY_SIZE
+
+
+class HotCacheEntry:
+    def __init__(self, body: bytes, status: int, headers: dict, expires_at: datetime, content_encoding: str | None):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.expires_at = expires_at
+        self.content_encoding = content_encoding
+
+
+class HotCache:
+    """Size-bounded LRU of small cached responses kept in memory.
+
+    It sits in front of the disk cache, so hot files like posters and logos can be served
+    without touching the database or the filesystem.
+    """
+
+    def __init__(self, max_size: int, max_entry_size: int):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, HotCacheEntry] = OrderedDict()
+
+    def get(self, hash: str) -> HotCacheEntry | None:
+        entry = self._entries.get(hash)
+
+        # expired entries go through the disk cache so they can be refreshed
+        if entry is not None and datetime.now() > entry.expires_at:
+            self.invalidate(hash)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(hash)
+        return entry
+
+    def put(
+        self,
+        hash: str,
+        body: bytes,
+        status: int,
+        headers: dict,
+        expires_at: datetime,
+        content_encoding: str | None = None,
+    ):
+        if len(body) > self.max_entry_size or datetime.now() > expires_at:
+            return
+
+        self.invalidate(hash)
+        self._entries[hash] = HotCacheEntry(body, status, headers, expires_at, content_encoding)
+        self.size += len(body)
+
+        # evict the least recently used entries until the budget is respected
+        while self.size > self.max_size:
+            _, entry = self._entries.popitem(last=False)
+            self.size -= len(entry.body)
+
+    def invalidate(self, hash: str):
+        entry = self._entries.pop(hash, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def to_json(self):
+        return {
+            "size": self.size,
+            "max_size": self.max_size,
+            "entry_count": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+hot_cache = HotCache(HOT_CACHE_MAX_SIZE, HOT_CACHE_MAX_ENTRY_SIZE)
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from .services import stream_client
+from .utils import get_media_type, is_success_status
+from .constants import HLS_CONTENT_TYPE_HEADERS, STREAM_METADATA_TTL, STREAM_METADATA_MAX_ENTRIES
+
+
+class StreamMetadata:
+    def __init__(
+        self,
+        url: str,
+        content_length: int | None,
+        content_type: str | None,
+        accept_ranges: str | None,
+        expires_at: datetime,
+    ):
+        self.url = url  # final url, after the redirects
+        self.content_length = content_length  # size of the whole file
+        self.content_type = content_type
+        self.accept_ranges = accept_ranges
+        self.expires_at = expires_at
+
+    def get_response_headers(self) -> dict:
+        response_headers = {}
+        if self.content_type is not None:
+            response_headers["content-type"] = self.content_type
+
+        # hls playlists are rewritten, so their size changes
+        if self.content_length is not None and get_media_type(response_headers) not in HLS_CONTENT_TYPE_HEADERS:
+            response_headers["content-length"] = str(self.content_length)
+
+        if self.accept_ranges is not None:
+            response_headers["accept-ranges"] = self.accept_ranges
+
+        return response_headers
+
+
+class StreamMetadataCache:
+    """Remembers for a while the metadata of the streams requested through the stream proxy.
+
+    HEAD requests are answered from it without contacting the host, and requests for urls that redirect,
+    like the ones of streamtape, go straight to the url they were last redirected to.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = timedelta(seconds=ttl)
+        self.max_entries = max_entries
+        self._entries: dict[str, StreamMetadata] = {}
+
+    def get(self, key: str) -> StreamMetadata | None:
+        metadata = self._entries.get(key)
+        if metadata is None:
+            return None
+
+        if datetime.now() > metadata.expires_at:
+            del self._entries[key]
+            return None
+
+        return metadata
+
+    def add(self, key: str, response: aiohttp.ClientResponse) -> StreamMetadata | None:
+        """Keeps the metadata of a successful response. Returns None for other responses"""
+        if not is_success_status(response.status):
+            return None
+
+        # partial responses have the size of the whole file on their content range
+        if response.status == 206:
+            size = response.headers.get("content-range", "").rpartition("/")[2]
+            accept_ranges = "bytes"
+        else:
+            size = response.headers.get("content-length", "")
+            accept_ranges = response.headers.get("accept-ranges")
+
+        metadata = StreamMetadata(
+            str(response.url),
+            int(size) if size.isdigit() else None,
+            response.headers.get("content-type"),
+            accept_ranges,
+            datetime.now() + self.ttl,
+        )
+
+        # re-insert the key so the entries stay sorted by expiration
+        self._entries.pop(key, None)
+        self._entries[key] = metadata
+
+        # drop the entries that have already expired, and the oldest ones if there are too many
+        now = datetime.now()
+        for entry_key in list(self._entries.keys()):
+            if len(self._entries) <= self.max_entries and now <= self._entries[entry_key].expires_at:
+                break
+            del self._entries[entry_key]
+
+        return metadata
+
+    def remove(self, key: str):
+        self._entries.pop(key, None)
+
+    async def request(self, key: str, url: str, headers: dict) -> aiohttp.ClientResponse:
+        """Sends a GET request for a stream, straight to the url it was last redirected to if it's known
+
+        If that url doesn't answer with a success status anymore, its metadata is dropped
+        and the redirects of `url` are followed again.
+        """
+        metadata = self.get(key)
+        if metadata is not None and metadata.url != url:
+            response = await stream_client.session.get(metadata.url, headers=headers)
+            if is_success_status(response.status):
+                return response
+
+            response.release()
+            self.remove(key)
+
+        return await stream_client.session.get(url, headers=headers)
+
+    async def fetch(self, key: str, url: str, headers: dict) -> tuple[int, StreamMetadata | None]:
+        """Requests the metadata of a stream from the host and keeps it. Returns the status of the response
+
+        Uses a HEAD request, or a request for the first byte if the host doesn't allow HEAD requests.
+        """
+        async with stream_client.session.head(url, headers=headers, allow_redirects=True) as response:
+            if response.status not in (405, 501):
+                return response.status, self.add(key, response)
+
+        async with stream_client.session.get(url, headers={**headers, "range": "bytes=0-0"}) as response:
+            return 200 if response.status == 206 else response.status, self.add(key, response)
+
+    def to_json(self):
+        return {
+            "entry_count": len(self._entries),
+            "ttl": self.ttl.total_seconds(),
+        }
+
+
+stream_metadata_cache = StreamMetadataCache(STREAM_METADATA_TTL, STREAM_METADATA_MAX_ENTRIES)
@@ -20,11 +20,18 @@ class CacheMeta(Base):
 
     response_headers: Mapped[str] = mapped_column(types.String, nullable=True)
     response_status: Mapped[int] = mapped_column(types.Integer, nullable=True)
+    content_type: Mapped[str] = mapped_column(types.String, nullable=True)
+    body_hash: Mapped[str] = mapped_column(types.String(length=64), nullable=True, index=True)
+    content_encoding: Mapped[str] = mapped_column(types.String, nullable=True)
+
+    hit_count: Mapped[int] = mapped_column(types.Integer, nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(types.DateTime, nullable=False)
     last_used_at: Mapped[datetime] = mapped_column(types.DateTime, nullable=True)
     expires_at: Mapped[datetime] = mapped_column(types.DateTime, nullable=True)
     relative_expires_str: Mapped[str] = mapped_column(types.String, nullable=True)
+    relative_stale_while_revalidate_str: Mapped[str] = mapped_column(types.String, nullable=True)
+    relative_stale_if_error_str: Mapped[str] = mapped_column(types.String, nullable=True)
 
     def __repr__(self):
         return f"<CacheMeta(id={self.id}, request_url={self.request_url}, created_at={self.created_at})>"
@@ -38,8 +45,14 @@ class CacheMeta(Base):
             "request_headers": self.request_headers,
             "response_headers": self.response_headers,
             "response_status": self.response_status,
+            "content_type": self.content_type,
+            "body_hash": self.body_hash,
+            "content_encoding": self.content_encoding,
+            "hit_count": self.hit_count,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "last_used_at": self.last_used_at.isoformat() if self.last_used_at else None,
             "expires_at": self.expires_at.isoformat() if self.expires_at else None,
             "relative_expires_str": self.relative_expires_str,
+            "relative_stale_while_revalidate_str": self.relative_stale_while_revalidate_str,
+            "relative_stale_if_error_str": self.relative_stale_if_error_str,
         }
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import asyncio
+
+from .services import stream_client
+from .constants import (
+    HLS_PREFETCH_SEGMENTS,
+    HLS_PREFETCH_MAX_SIZE,
+    HLS_PREFETCH_MAX_SEGMENT_SIZE,
+    HLS_PREFETCH_SESSION_TTL,
+)
+
+
+class PrefetchedSegment:
+    def __init__(self, body: bytes, status: int, headers: dict):
+        self.body = body
+        self.status = status
+        self.headers = headers
+
+
+class PrefetchSession:
+    """Segments of a media playlist being played, and the headers used to request them"""
+
+    def __init__(self, segment_urls: list[str], headers: dict):
+        self.segment_urls = segment_urls
+        self.headers = headers
+        self.last_used_at = datetime.now()
+
+
+class HLSPrefetcher:
+    """Downloads the next segments of a HLS stream into memory while the player is still playing the current one.
+
+    Once a segment of a known playlist is requested, the following `segment_count` ones are fetched in the
+    background, so the player's next requests are answered without waiting for the host. Segments are kept on
+    a LRU bounded by `max_size` bytes, and sessions not used for `session_ttl` seconds are dropped with them.
+    """
+
+    def __init__(self, segment_count: int, max_size: int, max_segment_size: int, session_ttl: float):
+        self.segment_count = segment_count
+        self.max_size = max_size
+        self.max_segment_size = max_segment_size
+        self.session_ttl = timedelta(seconds=session_ttl)
+        self.size = 0
+        self.hits = 0
+
+        self._sessions: dict[str, PrefetchSession] = {}
+        self._segment_sessions: dict[str, tuple[str, int]] = {}  # segment url -> (playlist url, index)
+        self._segments: OrderedDict[str, PrefetchedSegment] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def add_playlist(self, playlist_url: str, segment_urls: list[str], headers: dict):
+        """Registers the segments of a media playlist, replacing the previous version of live playlists"""
+        self.expire_sessions()
+        if not segment_urls:
+            return
+
+        previous_session = self._sessions.get(playlist_url)
+        if previous_session is not None:
+            for url in previous_session.segment_urls:
+                self._segment_sessions.pop(url, None)
+
+        self._sessions[playlist_url] = PrefetchSession(segment_urls, headers)
+        for index, url in enumerate(segment_urls):
+            self._segment_sessions[url] = (playlist_url, index)
+
+    async def get(self, url: str) -> PrefetchedSegment | None:
+        """Returns the segment of `url` if it has been prefetched, and starts prefetching the ones after it
+
+        Waits for the segment if it's still being prefetched. Returns None for urls that aren't known segments.
+        """
+        self.expire_sessions()
+        segment_session = self._segment_sessions.get(url)
+        if segment_session is None:
+            return None
+
+        playlist_url, index = segment_session
+        session = self._sessions[playlist_url]
+        session.last_used_at = datetime.now()
+
+        # prefetch the next segments
+        for next_url in session.segment_urls[index + 1 : index + 1 + self.segment_count]:
+            if next_url not in self._segments and next_url not in self._tasks:
+                task = asyncio.create_task(self._fetch(next_url, session.headers))
+                self._tasks[next_url] = task
+                task.add_done_callback(lambda _, next_url=next_url: self._tasks.pop(next_url, None))
+
+        # wait for the segment if it's already being downloaded, instead of requesting it again
+        task = self._tasks.get(url)
+        if task is not None:
+            await asyncio.shield(task)
+
+        segment = self._segments.get(url)
+        if segment is not None:
+            self._segments.move_to_end(url)
+            self.hits += 1
+
+        return segment
+
+    async def _fetch(self, url: str, headers: dict):
+        try:
+            async with stream_client.session.get(url, headers=headers) as response:
+                if response.status != 200 or (response.content_length or 0) > self.max_segment_size:
+                    return
+
+                # don't keep segments bigger than the limit, even if their size wasn't known up front
+                body = await response.content.read(self.max_segment_size + 1)
+                if len(body) > self.max_segment_size or not response.content.at_eof():
+                    return
+
+                response_headers = {key.lower(): value for key, value in response.headers.items()}
+                response_headers.pop("content-length", None)
+                response_headers.pop("content-encoding", None)
+                if "access-control-allow-origin" in response_headers.keys():
+                    response_headers.update({"access-control-allow-origin": "*"})
+
+            self._put(url, PrefetchedSegment(body, response.status, response_headers))
+
+        except Exception as e:
+            print(f"Error prefetching segment '{url}': {e}")
+
+    def _put(self, url: str, segment: PrefetchedSegment):
+        # the session may have expired while the segment was downloaded
+        if url not in self._segment_sessions:
+            return
+
+        self._pop(url)
+        self._segments[url] = segment
+        self.size += len(segment.body)
+
+        # evict the least recently used segments until the budget is respected
+        while self.size > self.max_size:
+            _, evicted_segment = self._segments.popitem(last=False)
+            self.size -= len(evicted_segment.body)
+
+    def _pop(self, url: str):
+        segment = self._segments.pop(url, None)
+        if segment is not None:
+            self.size -= len(segment.body)
+
+    def expire_sessions(self):
+        """Drops the sessions that haven't been used for a while, along with their segments"""
+        now = datetime.now()
+        for playlist_url, session in list(self._sessions.items()):
+            if now - session.last_used_at < self.session_ttl:
+                continue
+
+            del self._sessions[playlist_url]
+            for url in session.segment_urls:
+                if self._segment_sessions.get(url, (None,))[0] == playlist_url:
+                    del self._segment_sessions[url]
+                self._pop(url)
+                task = self._tasks.get(url)
+                if task is not None:
+                    task.cancel()
+
+    def to_json(self):
+        return {
+            "size": self.size,
+            "max_size": self.max_size,
+            "segment_count": len(self._segments),
+            "session_count": len(self._sessions),
+            "running_fetches": len(self._tasks),
+            "hits": self.hits,
+        }
+
+
+hls_prefetcher = HLSPrefetcher(
+    HLS_PREFETCH_SEGMENTS,
+    HLS_PREFETCH_MAX_SIZE,
+    HLS_PREFETCH_MAX_SEGMENT_SIZE,
+    HLS_PREFETCH_SESSION_TTL,
+)
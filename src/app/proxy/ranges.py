@@ -0,0 +1,246 @@
+from collections import OrderedDict
+from contextlib import aclosing
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable
+import asyncio
+import re
+
+import aiohttp
+from fastapi import Request
+from fastapi.exceptions import HTTPException
+
+from .utils import get_media_type, get_validator, get_stream_reopener, yield_chunks, handle_stream_errors
+from .constants import (
+    RANGE_CACHE_CONTENT_TYPES,
+    RANGE_CACHE_HEAD_SIZE,
+    RANGE_CACHE_TAIL_SIZE,
+    RANGE_CACHE_MAX_SIZE,
+    RANGE_CACHE_TTL,
+)
+
+
+class RangeCacheEntry:
+    """The first and last bytes of a progressive stream, and the headers to serve them with"""
+
+    def __init__(self, key: str, size: int, headers: dict, validator: str | None):
+        self.key = key
+        self.size = size  # size of the whole file
+        self.headers = headers
+        self.validator = validator
+        self.head = bytearray()
+        self.tail = b""
+        self.tail_start = size
+        self.last_used_at = datetime.now()
+
+    def get_bytes(self, start: int, end: int) -> bytes | None:
+        """Returns the bytes from `start` to `end`, inclusive, if they're all on the head or all on the tail"""
+        if end < len(self.head):
+            return bytes(self.head[start : end + 1])
+        elif self.tail and start >= self.tail_start:
+            return self.tail[start - self.tail_start : end - self.tail_start + 1]
+
+        return None
+
+    def get_response_headers(self, start: int, end: int, is_range: bool) -> dict:
+        response_headers = {**self.headers, "content-length": str(end - start + 1)}
+        if is_range:
+            response_headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+
+        return response_headers
+
+
+class RangeCache:
+    """Keeps the head and tail of recently played progressive streams, like MP4 files, in memory.
+
+    Before playing, players read the start of the file and, when its index (the "moov" atom of MP4 files) is
+    at the end, the tail too. Each of those probes would be a new request to the host, so the head is kept as the
+    first stream of a file is sent, and the tail is prefetched as soon as it starts. Entries are kept on a LRU
+    bounded by `max_size` bytes, and expire `ttl` seconds after they were last requested.
+    """
+
+    def __init__(self, head_size: int, tail_size: int, max_size: int, ttl: float):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.max_size = max_size
+        self.ttl = timedelta(seconds=ttl)
+        self.size = 0
+        self.hits = 0
+
+        self._entries: OrderedDict[str, RangeCacheEntry] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    def get(self, key: str) -> RangeCacheEntry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if datetime.now() - entry.last_used_at > self.ttl:
+            self._remove(entry)
+            return None
+
+        entry.last_used_at = datetime.now()
+        self._entries.move_to_end(key)
+        return entry
+
+    def add(
+        self,
+        key: str,
+        send_request: Callable[[dict], Awaitable[aiohttp.ClientResponse]],
+        headers: dict,
+        status: int,
+        response_headers: dict,
+    ) -> RangeCacheEntry | None:
+        """Creates the entry of a stream that starts at its first byte, and starts prefetching its tail
+
+        `send_request` sends a GET request for the stream with the given headers.
+
+        Returns None if the stream can't be kept, either because it's not a progressive stream,
+        its host doesn't support ranges or its size is unknown.
+        """
+        if key in self._entries or get_media_type(response_headers) not in RANGE_CACHE_CONTENT_TYPES:
+            return None
+
+        # get the size of the whole file
+        if status == 200 and response_headers.get("accept-ranges", "").lower() == "bytes":
+            size = response_headers.get("content-length", "")
+        elif status == 206:
+            match = re.fullmatch(r"bytes 0-\d+/(\d+)", response_headers.get("content-range", "").strip())
+            size = match[1] if match is not None else ""
+        else:
+            return None
+
+        if not size.isdigit():
+            return None
+
+        # the probes are answered with the same headers the host sent for the whole file
+        entry_headers = dict(response_headers)
+        for header in ("content-length", "content-range", "transfer-encoding"):
+            entry_headers.pop(header, None)
+
+        entry = RangeCacheEntry(key, int(size), entry_headers, get_validator(response_headers))
+        self._entries[key] = entry
+
+        if entry.size > self.head_size:
+            task = asyncio.create_task(self._fetch_tail(entry, send_request, headers))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        return entry
+
+    async def iter_recording_head(self, entry: RangeCacheEntry, chunks: AsyncIterator[bytes]):
+        """Yields the chunks of a stream that starts at the first byte, keeping the first ones as the entry's head"""
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                missing_size = self.head_size - len(entry.head)
+                if missing_size > 0:
+                    entry.head += chunk[:missing_size]
+                    self._resize(entry, min(len(chunk), missing_size))
+
+                yield chunk
+
+    async def _fetch_tail(
+        self,
+        entry: RangeCacheEntry,
+        send_request: Callable[[dict], Awaitable[aiohttp.ClientResponse]],
+        headers: dict,
+    ):
+        tail_start = max(self.head_size, entry.size - self.tail_size)
+        tail_headers = {**headers, "range": f"bytes={tail_start}-{entry.size - 1}"}
+        if entry.validator is not None:
+            tail_headers["if-range"] = entry.validator
+
+        try:
+            async with await send_request(tail_headers) as response:
+                # the file may have changed since the head was requested
+                content_range = response.headers.get("content-range", "")
+                if response.status != 206 or content_range != f"bytes {tail_start}-{entry.size - 1}/{entry.size}":
+                    return
+
+                tail = await response.read()
+
+        except Exception as e:
+            print(f"Error prefetching the tail of a stream: {e}")
+            return
+
+        if len(tail) == entry.size - tail_start and entry.key in self._entries:
+            entry.tail = tail
+            entry.tail_start = tail_start
+            self._resize(entry, len(tail))
+
+    def _resize(self, entry: RangeCacheEntry, added_size: int):
+        # entries removed while their bytes were being received don't count anymore
+        if self._entries.get(entry.key) is not entry:
+            return
+
+        self.size += added_size
+
+        # evict the least recently used entries until the budget is respected
+        while self.size > self.max_size and self._entries:
+            self._remove(next(iter(self._entries.values())))
+
+    def _remove(self, entry: RangeCacheEntry):
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+            self.size -= len(entry.head) + len(entry.tail)
+
+    def to_json(self):
+        return {
+            "size": self.size,
+            "max_size": self.max_size,
+            "entry_count": len(self._entries),
+            "hits": self.hits,
+        }
+
+
+async def yield_cached_range(
+    request: Request,
+    entry: RangeCacheEntry,
+    start: int,
+    end: int,
+    send_request: Callable[[dict], Awaitable[aiohttp.ClientResponse]],
+    headers: dict,
+):
+    """Yields a range that starts on the cached head of a stream, and requests the rest of it from the host meanwhile"""
+    head = bytes(entry.head[start : end + 1])
+    rest_start = start + len(head)
+
+    rest_task = None
+    if rest_start <= end:
+        rest_headers = {**headers, "range": f"bytes={rest_start}-{end}"}
+        if entry.validator is not None:
+            rest_headers["if-range"] = entry.validator
+        rest_task = asyncio.create_task(send_request(rest_headers))
+
+    try:
+        async with handle_stream_errors():
+            yield head
+            if rest_task is None:
+                return
+
+            response = await rest_task
+            rest_task = None
+
+            # the file changed since its head was kept
+            content_range = response.headers.get("content-range", "")
+            if response.status != 206 or not content_range.startswith(f"bytes {rest_start}-"):
+                response.release()
+                raise HTTPException(status_code=502, detail="Upstream file changed")
+
+            reopen = get_stream_reopener(send_request, rest_headers, response)
+            async for chunk in yield_chunks(request, response, reopen=reopen):
+                yield chunk
+
+    # cleanup
+    finally:
+        if rest_task is not None:
+            rest_task.cancel()
+            if rest_task.done() and not rest_task.cancelled() and rest_task.exception() is None:
+                rest_task.result().release()
+
+
+range_cache = RangeCache(
+    RANGE_CACHE_HEAD_SIZE,
+    RANGE_CACHE_TAIL_SIZE,
+    RANGE_CACHE_MAX_SIZE,
+    RANGE_CACHE_TTL,
+)
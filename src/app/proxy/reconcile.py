@@ -0,0 +1,98 @@
+import asyncio
+import os
+
+from sqlalchemy import select, update, delete, bindparam
+
+from ..db import SessionLocal
+from .models import CacheMeta
+from .usage import cache_usage
+from .utils import migrate_flat_cache_dir, get_body_path, remove_files
+from .constants import CACHE_DIR
+
+
+def scan_cache_files(dir_path: str) -> dict[str, tuple[str, int]]:
+    """Returns the path and size of every file on the cache directory and its subdirectories, keyed by file name"""
+    files = {}
+    for root, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            files[file_name] = (path, os.path.getsize(path))
+
+    return files
+
+
+async def reconcile_cache() -> dict:
+    """Brings the cache directory and the database back to a consistent state
+
+    - Records left marked as being downloaded by a crash are reset, so they're downloaded again on their next read.
+    - Temporary files of interrupted downloads and files no record references are deleted.
+    - Records whose file is missing are deleted.
+    - The size totals and the size of each record are recomputed from the files on the disk.
+
+    No download can be running while this runs, so it should only be called on startup or while the server is stopped.
+    """
+    await asyncio.to_thread(migrate_flat_cache_dir)
+
+    async with SessionLocal() as db:
+        # scan the disk while the records are queried
+        stmt = select(CacheMeta.id, CacheMeta.body_hash, CacheMeta.is_downloaded, CacheMeta.cache_size)
+        files, results = await asyncio.gather(
+            asyncio.to_thread(scan_cache_files, CACHE_DIR),
+            db.execute(stmt),
+        )
+        rows = results.all()
+
+        stuck_ids = []
+        interrupted_ids = []
+        missing_ids = []
+        resized_rows = []
+        referenced_files = set()
+        for id, body_hash, is_downloaded, cache_size in rows:
+            body_path = get_body_path(body_hash, id)
+            file_name = os.path.basename(body_path)
+            has_file = file_name in files
+
+            # records of interrupted refreshes still have their previous file
+            if is_downloaded is False:
+                if has_file:
+                    stuck_ids.append(id)
+                else:
+                    interrupted_ids.append(id)
+
+            elif is_downloaded and not has_file:
+                missing_ids.append(id)
+                continue
+
+            if has_file:
+                referenced_files.add(file_name)
+                _, file_size = files[file_name]
+                if file_size != cache_size:
+                    resized_rows.append({"b_id": id, "b_cache_size": file_size})
+
+        # temporary files and files without records are never served
+        orphan_paths = [path for file_name, (path, _) in files.items() if file_name not in referenced_files]
+        remove_task = asyncio.create_task(asyncio.to_thread(remove_files, orphan_paths))
+
+        if stuck_ids:
+            await db.execute(update(CacheMeta).where(CacheMeta.id.in_(stuck_ids)).values(is_downloaded=True))
+        if interrupted_ids:
+            await db.execute(update(CacheMeta).where(CacheMeta.id.in_(interrupted_ids)).values(is_downloaded=None))
+        if missing_ids:
+            await db.execute(delete(CacheMeta).where(CacheMeta.id.in_(missing_ids)))
+        if resized_rows:
+            connection = await db.connection()
+            stmt = update(CacheMeta).where(CacheMeta.id == bindparam("b_id")).values(cache_size=bindparam("b_cache_size"))
+            await connection.execute(stmt, resized_rows)
+        await db.commit()
+
+        await remove_task
+
+    await cache_usage.reconcile()
+
+    return {
+        "reset_records": len(stuck_ids) + len(interrupted_ids),
+        "deleted_records": len(missing_ids),
+        "resized_records": len(resized_rows),
+        "deleted_files": len(orphan_paths),
+        **cache_usage.to_json(),
+    }
@@ -1,21 +1,65 @@
-from datetime import datetime
-import asyncio
+from datetime import datetime, timedelta
 import hashlib
+import asyncio
+import time
 import ast
 import os
 
+from sqlalchemy import select, delete, func, or_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 import aiofiles
 import aiohttp
 
 from src.utils.lock_manager import DynamicLockManager
-from .utils import str_to_timedelta, get_file_size
+from src.utils.http_client import HTTPClient, shared_client
+from ..db import SessionLocal
+from .utils import (
+    str_to_timedelta,
+    get_file_size,
+    get_media_type,
+    get_cache_hash,
+    get_cache_path,
+    get_body_path,
+    get_temp_path,
+    remove_files,
+    is_compressible,
+    is_success_status,
+    get_negative_ttl,
+    compress_file,
+    get_conditional_headers,
+    merge_revalidated_headers,
+)
 from .models import CacheMeta
-from .constants import CACHE_DIR
+from .fills import CacheFill, active_fills
+from .usage import cache_usage
+from .access import access_tracker
+from .hot_cache import hot_cache
+from .uncacheable import uncacheable_keys
+from .stats import cache_stats
+from .constants import (
+    CACHE_DIR,
+    CACHE_CHUNK_SIZE,
+    CACHE_COMPRESSION_MIN_SIZE,
+    CACHE_MAX_ENTRY_SIZE,
+    STREAM_CONNECTION_LIMIT,
+    STREAM_CONNECTION_LIMIT_PER_HOST,
+    STREAM_KEEPALIVE_TIMEOUT,
+    STREAM_DNS_CACHE_TTL,
+)
 
 delete_lock = asyncio.Lock()
 
+# app-lifetime connection pool shared by every stream proxied through the server
+# there's no total timeout, since a single movie can be streamed for hours
+stream_client = HTTPClient(
+    limit=STREAM_CONNECTION_LIMIT,
+    limit_per_host=STREAM_CONNECTION_LIMIT_PER_HOST,
+    keepalive_timeout=STREAM_KEEPALIVE_TIMEOUT,
+    ttl_dns_cache=STREAM_DNS_CACHE_TTL,
+    timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60),
+)
+
 
 class CacheMetaServiceExceptions:
     class CacheNotFoundError(Exception):
@@ -30,9 +74,30 @@ class CacheMetaServiceExceptions:
     class UnexpectedStatusCode(Exception):
         pass
 
+    class EntryTooLargeError(Exception):
+        pass
+
 
 lock_manager = DynamicLockManager()
 
+# references to downloads running in the background, so they don't get garbage collected
+download_tasks: set[asyncio.Task] = set()
+
+
+async def release_body(db: AsyncSession, body_hash: str):
+    """Deletes the file of a cached body once no record references it anymore"""
+    body_lock = await lock_manager.get_lock(f"{body_hash}.body")
+    async with body_lock:
+        stmt = select(func.count()).select_from(CacheMeta).where(CacheMeta.body_hash == body_hash)
+        if await db.scalar(stmt):
+            return
+
+        body_path = get_cache_path(body_hash)
+        if os.path.exists(body_path):
+            cache_size = get_file_size(body_path)
+            os.remove(body_path)
+            cache_usage.remove(cache_size)
+
 
 # TODO: add some docstrings explaining the logic on each method
 class CacheMetaService:
@@ -40,7 +105,14 @@ class CacheMetaService:
         os.makedirs(CACHE_DIR, exist_ok=True)
         self.db = db
 
-    async def create(self, request_url: str, request_headers: dict | None = None, relative_expires_str: str | None = None) -> CacheMeta:
+    async def create(
+        self,
+        request_url: str,
+        request_headers: dict | None = None,
+        relative_expires_str: str | None = None,
+        relative_stale_while_revalidate_str: str | None = None,
+        relative_stale_if_error_str: str | None = None,
+    ) -> CacheMeta:
         # set default values if nothing is specified
         if request_headers is None:
             request_headers = {}
@@ -48,9 +120,7 @@ class CacheMetaService:
             relative_expires_str = "24h"
 
         # get hash of url+headers
-        hash = hashlib.md5()
-        hash.update(f"{request_url} {request_headers}".encode())
-        hash = hash.hexdigest()
+        hash = get_cache_hash(request_url, request_headers)
 
         cache_lock = await lock_manager.get_lock(hash)
 
@@ -63,6 +133,9 @@ class CacheMetaService:
                 request_headers=str(request_headers),
                 created_at=datetime.now(),
                 last_used_at=datetime.now(),
+                hit_count=0,
+                relative_stale_while_revalidate_str=relative_stale_while_revalidate_str,
+                relative_stale_if_error_str=relative_stale_if_error_str,
             )
 
             # create new record on the database
@@ -73,80 +146,319 @@ class CacheMetaService:
                 msg = f"A record for '{request_url}' and '{request_headers}' already exists!"
                 raise CacheMetaServiceExceptions.CacheAlreadyExistsError(msg)
 
-            try:
-                # run the update method to fill the remaining values
-                return await self.update(hash, relative_expires_str)
-            except Exception as e:
-                # delete the uncompleted record if something fails
-                await self.delete(hash)
-
-                raise e
-
-    async def update(self, hash: str, relative_expires_str: str | None = None) -> CacheMeta:
+            # run the update method to fill the remaining values
+            # the uncompleted record is deleted by the download if something fails
+            return await self.update(hash, relative_expires_str, delete_on_error=True)
+
+    async def update(
+        self,
+        hash: str,
+        relative_expires_str: str | None = None,
+        delete_on_error: bool = False,
+        in_background: bool = False,
+    ) -> CacheMeta:
+        """Starts downloading the file of a record in the background.
+
+        Returns as soon as the upstream response headers are received, the file can then be
+        streamed while it's written through the `CacheFill` saved on `active_fills`.
+
+        If `in_background` is true, returns right away without marking the record as being
+        downloaded, so its previous file keeps being served until the new one is complete.
+        """
         # get CacheMeta instance
         cache_meta = await self.db.get(CacheMeta, hash)
         if cache_meta is None:
             msg = f"Record with hash '{hash}' could not be found."
             raise CacheMetaServiceExceptions.CacheNotFoundError(msg)
 
-        # if is_downloaded is false, that means the file is already being downloaded/updated
-        if cache_meta.is_downloaded is False:
+        # if there's a fill for the record, that means the file is already being downloaded/updated
+        if hash in active_fills:
             msg = f"{cache_meta} is already being updated!"
             raise CacheMetaServiceExceptions.SimultaneousUpdateError(msg)
 
-        try:
-            # mark record as being downloaded
-            cache_meta.is_downloaded = False
-            await self.db.commit()
+        # register the fill before anything else so readers can start waiting on it
+        # files are downloaded to a temporary file that is only published once it's complete
+        # so a partial file is never served and the previous version is left intact if the download fails
+        is_refresh = os.path.exists(get_body_path(cache_meta.body_hash, hash))
+        fill = CacheFill(hash, get_temp_path(get_cache_path(hash)))
+        active_fills[hash] = fill
 
-            # re-atach the CacheMeta instance into the current transaction
-            cache_meta = await self.db.get(CacheMeta, hash)
+        # mark record as being downloaded
+        if not in_background:
+            try:
+                cache_meta.is_downloaded = False
+                await self.db.commit()
+            except Exception as e:
+                active_fills.pop(hash, None)
+                await fill.finish(e)
+                raise e
+
+        # re-atach the CacheMeta instance into the current transaction
+        cache_meta = await self.db.get(CacheMeta, hash)
+
+        # send the validators of the cached response when refreshing it
+        # so an unchanged file doesn't need to be downloaded again
+        request_headers = ast.literal_eval(cache_meta.request_headers)
+        if is_refresh and cache_meta.response_headers is not None:
+            request_headers.update(get_conditional_headers(ast.literal_eval(cache_meta.response_headers)))
+
+        # the stale file is served instead of an error while inside its stale-if-error window
+        stale_for = datetime.now() - cache_meta.expires_at if cache_meta.expires_at is not None else timedelta(0)
+        can_serve_stale_on_error = stale_for < str_to_timedelta(cache_meta.relative_stale_if_error_str or "")
+
+        # start the download on the background
+        task = asyncio.create_task(
+            self._download(
+                fill,
+                cache_meta.request_url,
+                request_headers,
+                relative_expires_str,
+                delete_on_error,
+                is_refresh,
+                # errors only replace a valid cached response once it can't be served as stale anymore
+                # so a removed page is cached as an error instead of being requested again on every request
+                not is_refresh or not is_success_status(cache_meta.response_status) or not can_serve_stale_on_error,
+            )
+        )
+        download_tasks.add(task)
+        task.add_done_callback(download_tasks.discard)
+
+        # wait for the response to be streamable
+        # this raises the download exception if it fails before that
+        if not in_background:
+            await fill.wait_for_response()
+
+            # load the data of a file that has been revalidated instead of downloaded
+            if fill.headers is None:
+                cache_stats.record_request("revalidated")
+                await self.db.refresh(cache_meta)
+            else:
+                cache_stats.record_request("miss")
+
+        return cache_meta
 
-            # send the request for the request_url on the record with the request_headers
-            # also on the record and save the response to the same file
-            cache_path = os.path.join(CACHE_DIR, hash)
-            request_url = cache_meta.request_url
-            request_headers = ast.literal_eval(cache_meta.request_headers)
-            async with aiohttp.ClientSession() as session:
-                async with session.get(request_url, headers=request_headers) as response:
-                    # raise exception if the response status code is invalid
-                    if not (199 < response.status < 300):
+    async def _download(
+        self,
+        fill: CacheFill,
+        request_url: str,
+        request_headers: dict,
+        relative_expires_str: str | None,
+        delete_on_error: bool,
+        is_refresh: bool,
+        cache_errors: bool,
+    ):
+        """Downloads the file of a record to the disk, reporting its progress to `fill`.
+
+        Uses its own database session, since the download outlives the request that started it.
+        Error responses are cached as well if `cache_errors` is true and their status has a negative TTL.
+        """
+        body_hash = hashlib.sha256()
+        start_time = time.perf_counter()
+        is_temp_file_published = False
+        async with SessionLocal() as db:
+            try:
+                # send the request for the request_url on the record with the request_headers
+                # also on the record and save the response to the same file
+                async with shared_client.session.get(request_url, headers=request_headers) as response:
+                    response_time = time.perf_counter() - start_time
+                    # a file being refreshed may be revalidated instead of downloaded again
+                    is_not_modified = response.status == 304 and is_refresh
+
+                    # raise exception if the response status code is invalid and shouldn't be cached
+                    is_error_cached = cache_errors and get_negative_ttl(response.status) is not None
+                    if not is_not_modified and not is_success_status(response.status) and not is_error_cached:
                         msg = f"Unexpected status code when caching file: {response.status}"
                         raise CacheMetaServiceExceptions.UnexpectedStatusCode(msg)
 
-                    # save the response locally
-                    async with aiofiles.open(cache_path, "wb") as file:
-                        async for chunk in response.content.iter_chunked(1024 * 1024):
-                            await file.write(chunk)
-
-                    # update the record with the new data
-                    cache_meta.cache_size = get_file_size(cache_path)  # update cache_size
-                    cache_meta.response_headers = str(dict(response.headers))  # update response_headers
-                    cache_meta.response_status = response.status  # update response_status
+                    # don't even start downloading files known to be too big
+                    if not is_not_modified and (response.content_length or 0) > CACHE_MAX_ENTRY_SIZE:
+                        msg = f"'{request_url}' is too big to be cached: {response.content_length} bytes"
+                        raise CacheMetaServiceExceptions.EntryTooLargeError(msg)
+
+                    if not is_not_modified:
+                        # a temporary file left behind by an interrupted download is truncated as soon as it's opened
+                        previous_size = get_file_size(fill.path) if os.path.exists(fill.path) else None
+                        os.makedirs(os.path.dirname(fill.path), exist_ok=True)
+
+                        # save the response locally, letting readers stream each chunk as soon as it's flushed
+                        # the cache usage is kept up to date with the bytes on the disk as they're written
+                        async with aiofiles.open(fill.path, "wb") as file:
+                            if previous_size is not None:
+                                cache_usage.remove(previous_size, file_count=0)
+                            else:
+                                cache_usage.add(0)
+
+                            await fill.set_response(response.status, dict(response.headers))
+                            async for chunk in response.content.iter_chunked(CACHE_CHUNK_SIZE):
+                                # the size may be unknown up front, so it's also enforced while downloading
+                                if fill.size + len(chunk) > CACHE_MAX_ENTRY_SIZE:
+                                    msg = f"'{request_url}' is too big to be cached: over {CACHE_MAX_ENTRY_SIZE} bytes"
+                                    raise CacheMetaServiceExceptions.EntryTooLargeError(msg)
+
+                                await file.write(chunk)
+                                await file.flush()
+                                body_hash.update(chunk)
+                                await fill.append(len(chunk))
+                                cache_usage.add(len(chunk), file_count=0)
+                                cache_stats.bytes_from_upstream += len(chunk)
+
+                    revalidation_headers = dict(response.headers)
+
+                # compress text-like files before publishing them
+                # the uncompressed temporary file is kept until the fill is finished, since readers can still join it
+                body_path = fill.path
+                body_key = body_hash.hexdigest()
+                body_size = fill.size
+                content_encoding = None
+                if (
+                    not is_not_modified
+                    and fill.size >= CACHE_COMPRESSION_MIN_SIZE
+                    and is_compressible(get_media_type(fill.headers))
+                ):
+                    body_path = f"{fill.path}.gz"
+                    body_size = await asyncio.to_thread(compress_file, fill.path, body_path)
+                    cache_usage.add(body_size)
+
+                    # compressed bodies get their own key so they never share a file with an uncompressed one
+                    body_key = hashlib.sha256(f"{body_key}.gzip".encode()).hexdigest()
+                    content_encoding = "gzip"
+
+                # update the record with the new data
+                cache_meta = await db.get(CacheMeta, fill.hash)
+                previous_body_hash = None
+                if cache_meta is not None:
+                    if is_not_modified:
+                        # keep the cached file and only update its validators and freshness headers
+                        response_headers = ast.literal_eval(cache_meta.response_headers)
+                        response_headers = merge_revalidated_headers(response_headers, revalidation_headers)
+                        cache_meta.response_headers = str(response_headers)  # update response_headers
+                    else:
+                        previous_body_hash = cache_meta.body_hash or cache_meta.id
+                        cache_meta.body_hash = body_key  # update body_hash
+                        cache_meta.cache_size = body_size  # update cache_size
+                        cache_meta.content_encoding = content_encoding  # update content_encoding
+                        cache_meta.response_headers = str(fill.headers)  # update response_headers
+                        cache_meta.response_status = fill.status  # update response_status
+                        cache_meta.content_type = get_media_type(fill.headers)  # update content_type
                     if relative_expires_str is not None:  # update relative_expires_str if needed
                         cache_meta.relative_expires_str = relative_expires_str
                     else:
                         relative_expires_str = cache_meta.relative_expires_str
+                    if not is_success_status(cache_meta.response_status):  # errors expire sooner
+                        relative_expires_str = get_negative_ttl(cache_meta.response_status) or relative_expires_str
                     cache_meta.expires_at = datetime.now() + str_to_timedelta(relative_expires_str)  # update expire date
 
-            # set is_downloaded to true
-            cache_meta.is_downloaded = True
+                    # set is_downloaded to true
+                    cache_meta.is_downloaded = True
+
+                if is_not_modified or cache_meta is None:
+                    await db.commit()
+
+                else:
+                    # publish the complete file, unless the same content is already cached under another record
+                    # the record is committed while the body is locked, so it can't be released in the meantime
+                    body_lock = await lock_manager.get_lock(f"{body_key}.body")
+                    async with body_lock:
+                        # the temporary file is linked instead of moved, so it can still be opened until the fill finishes
+                        cache_path = get_cache_path(body_key)
+                        is_body_published = False
+                        if os.path.exists(cache_path):
+                            if body_path != fill.path:
+                                os.remove(body_path)
+                                cache_usage.remove(body_size)
+                        else:
+                            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                            if body_path != fill.path:
+                                os.replace(body_path, cache_path)
+                            else:
+                                os.link(fill.path, cache_path)
+                                is_temp_file_published = True
+                            is_body_published = True
+
+                        try:
+                            await db.commit()
+                        except Exception:
+                            # no record references the published file, so remove it before the body is unlocked
+                            if is_body_published:
+                                os.remove(cache_path)
+                                if is_temp_file_published:
+                                    is_temp_file_published = False
+                                else:
+                                    cache_usage.remove(body_size)
+                            raise
+
+                    # delete the previous version of the file if no other record uses it
+                    if previous_body_hash != body_key:
+                        await release_body(db, previous_body_hash)
+
+                # drop the previous version from memory
+                hot_cache.invalidate(fill.hash)
+
+                await fill.finish()
+
+                # new readers are served from the published file once the fill is finished
+                if os.path.exists(fill.path):
+                    os.remove(fill.path)
+                    if not is_temp_file_published:
+                        cache_usage.remove(fill.size)
+
+                cache_stats.record_fill(response_time, None if is_not_modified else time.perf_counter() - start_time)
 
-            # commit changes and return the updated object
-            await self.db.commit()
-            await self.db.refresh(cache_meta)
-
-            return cache_meta
-
-        except Exception as e:
-            # reset is_downloaded to null if anything fails
-            cache_meta = await self.db.get(CacheMeta, hash)
-            cache_meta.is_downloaded = None
-            await self.db.commit()
-
-            raise e
-
-    async def read(self, hash: str, relative_expires_str: str | None = None) -> CacheMeta:
+            except Exception as e:
+                # discard the changes made to the record, so it keeps pointing to its previous file
+                await db.rollback()
+
+                # delete the uncompleted files
+                for path in (fill.path, f"{fill.path}.gz"):
+                    if os.path.exists(path):
+                        cache_size = get_file_size(path)
+                        os.remove(path)
+                        if path != fill.path or not is_temp_file_published:
+                            cache_usage.remove(cache_size)
+
+                # responses too big to be cached are relayed straight from the host for a while
+                is_too_large = isinstance(e, CacheMetaServiceExceptions.EntryTooLargeError)
+                if is_too_large:
+                    uncacheable_keys.add(fill.hash)
+
+                # delete the uncompleted record if anything fails, or reset is_downloaded
+                # to true if the previous file is still intact and to null otherwise
+                # records of responses that became too big are deleted along with their previous file
+                cache_meta = await db.get(CacheMeta, fill.hash)
+                if cache_meta is not None:
+                    previous_body_hash = cache_meta.body_hash or cache_meta.id
+                    if delete_on_error or is_too_large:
+                        await db.delete(cache_meta)
+                    elif is_refresh:
+                        cache_meta.is_downloaded = True
+                    else:
+                        cache_meta.is_downloaded = None
+                    await db.commit()
+
+                    if is_too_large:
+                        if is_refresh:
+                            cache_stats.record_eviction("too_large", cache_meta.cache_size)
+                        access_tracker.forget(fill.hash)
+                        hot_cache.invalidate(fill.hash)
+                        await release_body(db, previous_body_hash)
+
+                await fill.finish(e)
+                cache_stats.fill_errors += 1
+
+            finally:
+                # make sure no reader is left waiting if the download gets cancelled
+                if not fill.is_finished:
+                    await fill.finish(asyncio.CancelledError())
+
+                active_fills.pop(fill.hash, None)
+
+    async def read(
+        self,
+        hash: str,
+        relative_expires_str: str | None = None,
+        relative_stale_while_revalidate_str: str | None = None,
+        relative_stale_if_error_str: str | None = None,
+    ) -> CacheMeta:
         cache_lock = await lock_manager.get_lock(hash)
 
         async with cache_lock:
@@ -156,27 +468,133 @@ class CacheMetaService:
                 msg = f"Record with hash '{hash}' could not be found."
                 raise CacheMetaServiceExceptions.CacheNotFoundError(msg)
 
-            # check if it's already being cached
-            # and wait for the download to finish
-            while cache_meta.is_downloaded is False:
-                await self.db.refresh(cache_meta)
-                await asyncio.sleep(0.05)
+            # update the stale windows if needed
+            if relative_stale_while_revalidate_str not in (None, cache_meta.relative_stale_while_revalidate_str):
+                cache_meta.relative_stale_while_revalidate_str = relative_stale_while_revalidate_str
+            if relative_stale_if_error_str not in (None, cache_meta.relative_stale_if_error_str):
+                cache_meta.relative_stale_if_error_str = relative_stale_if_error_str
+
+            # a record being cached without a fill was left behind by an interrupted download, so mark it as pending
+            # files with a fill are still being downloaded and will be streamed from it while they're written
+            if cache_meta.is_downloaded is False and hash not in active_fills:
+                cache_meta.is_downloaded = None
+                await self._commit_record(cache_meta)
 
             # check if it's pending to be cached
             if cache_meta.is_downloaded is None:
                 cache_meta = await self.update(cache_meta.id, relative_expires_str)
 
             # check if the cached file has expired
-            if datetime.now() > cache_meta.expires_at:
-                cache_meta = await self.update(cache_meta.id, relative_expires_str)
+            elif cache_meta.is_downloaded and datetime.now() > cache_meta.expires_at:
+                cache_meta = await self.refresh_expired(cache_meta, relative_expires_str)
 
-            # update last_used_at
-            cache_meta.last_used_at = datetime.now()
-            await self.db.commit()
-            await self.db.refresh(cache_meta)
+            elif cache_meta.is_downloaded:
+                cache_stats.record_request("hit")
+
+            # the file is still being downloaded by another request
+            else:
+                cache_stats.record_request("miss")
+
+            # save changes to the stale windows
+            if self.db.dirty:
+                await self._commit_record(cache_meta)
+
+            # register the access, last_used_at and hit_count are written to the database later in batches
+            access_tracker.touch(hash)
 
         return cache_meta
 
+    async def _commit_record(self, cache_meta: CacheMeta):
+        """Commits the session and reloads the record, whose attributes are expired by the commit
+
+        Expired attributes can't be lazy loaded by an async session, so the record has to be
+        refreshed before it's read again.
+        """
+        await self.db.commit()
+        await self.db.refresh(cache_meta)
+
+    async def refresh_expired(self, cache_meta: CacheMeta, relative_expires_str: str | None = None) -> CacheMeta:
+        """Refreshes the file of an expired record, or keeps serving the stale one if its windows allow it
+
+        - Inside the stale-while-revalidate window, the stale file is served while it's refreshed in the background.
+        - Inside the stale-if-error window, the stale file is served if the refresh fails.
+        """
+        stale_for = datetime.now() - cache_meta.expires_at
+
+        # the stale file is already being refreshed in the background
+        if cache_meta.id in active_fills:
+            cache_stats.record_request("stale")
+            return cache_meta
+
+        # serve the stale file and refresh it in the background
+        if stale_for < str_to_timedelta(cache_meta.relative_stale_while_revalidate_str or ""):
+            await self.update(cache_meta.id, relative_expires_str, in_background=True)
+            cache_stats.record_request("stale")
+            return cache_meta
+
+        try:
+            return await self.update(cache_meta.id, relative_expires_str)
+
+        except Exception as e:
+            # serve the stale file if the upstream fails
+            if stale_for < str_to_timedelta(cache_meta.relative_stale_if_error_str or ""):
+                print(f"Serving stale cache for '{cache_meta.request_url}' after refresh error: {e}")
+                cache_stats.record_request("stale")
+                await self.db.refresh(cache_meta)
+                return cache_meta
+
+            raise e
+
+    async def purge(
+        self,
+        host: str | None = None,
+        older_than: str | None = None,
+        content_type: str | None = None,
+    ) -> dict:
+        """Deletes every record matching the filters with a single statement, along with their files
+
+        - `host`: only records whose url is from this host.
+        - `older_than`: only records created longer ago than this relative time (e.g.: "7d").
+        - `content_type`: only records whose media type starts with this value (e.g.: "image/").
+
+        Records being downloaded are skipped. Returns the number of records and files deleted and the bytes freed.
+        """
+        stmt = delete(CacheMeta).where(CacheMeta.id.not_in(list(active_fills.keys())))
+        if host is not None:
+            # match the host with or without a port, path or query
+            patterns = [f"{scheme}://{host}{suffix}" for scheme in ("http", "https") for suffix in ("", "/%", ":%", "?%")]
+            stmt = stmt.where(or_(*(CacheMeta.request_url.ilike(pattern) for pattern in patterns)))
+        if older_than is not None:
+            stmt = stmt.where(CacheMeta.created_at < datetime.now() - str_to_timedelta(older_than))
+        if content_type is not None:
+            stmt = stmt.where(CacheMeta.content_type.startswith(content_type.lower()))
+
+        async with delete_lock:
+            results = await self.db.execute(stmt.returning(CacheMeta.id, CacheMeta.body_hash, CacheMeta.cache_size))
+            rows = results.all()
+            await self.db.commit()
+
+            for row in rows:
+                access_tracker.forget(row.id)
+                hot_cache.invalidate(row.id)
+                cache_stats.record_eviction("purge", row.cache_size)
+
+            # only delete the files no remaining record references
+            body_hashes = {row.body_hash or row.id for row in rows}
+            stmt = select(CacheMeta.body_hash).where(CacheMeta.body_hash.in_(body_hashes)).distinct()
+            referenced_body_hashes = set((await self.db.scalars(stmt)).all())
+            paths = [get_cache_path(body_hash) for body_hash in body_hashes - referenced_body_hashes]
+
+            # remove the files on a thread, so the event loop isn't blocked by thousands of unlinks
+            file_count, size = await asyncio.to_thread(remove_files, paths)
+            cache_usage.remove(size, file_count)
+
+        return {
+            "deleted_records": len(rows),
+            "deleted_files": file_count,
+            "freed_bytes": size,
+        }
+
     async def delete(self, hash: str):
         async with delete_lock:
             cache_lock = await lock_manager.get_lock(hash)
@@ -185,32 +603,51 @@ class CacheMetaService:
             async with cache_lock:
                 cache_meta = await self.db.get(CacheMeta, hash)
                 if cache_meta is not None:
+                    body_hash = cache_meta.body_hash or hash
+
                     # delete cache meta
                     await self.db.delete(cache_meta)
                     await self.db.commit()
+                    access_tracker.forget(hash)
+                    hot_cache.invalidate(hash)
+
+                    # delete cache file if no other record uses it
+                    await release_body(self.db, body_hash)
 
-                    # delete cache file
-                    cache_path = os.path.join(CACHE_DIR, hash)
-                    if os.path.exists(cache_path):
-                        os.remove(cache_path)
+    async def create_or_read_from_url(
+        self,
+        request_url: str,
+        request_headers: dict | None = None,
+        relative_expires_str: str | None = None,
+        relative_stale_while_revalidate_str: str | None = None,
+        relative_stale_if_error_str: str | None = None,
+    ):
 
-    async def create_or_read_from_url(self, request_url: str, request_headers: dict | None = None, relative_expires_str: str | None = None):
         if request_headers is None:
             request_headers = {}
 
         # get hash of url+headers
-        hash = hashlib.md5()
-        hash.update(f"{request_url} {request_headers}".encode())
-        hash = hash.hexdigest()
+        hash = get_cache_hash(request_url, request_headers)
 
         local_cache_lock = await lock_manager.get_lock(f"{hash}.create_or_read_from_url")
         async with local_cache_lock:
             try:
-                cache_meta = await self.read(hash, relative_expires_str)
+                cache_meta = await self.read(
+                    hash,
+                    relative_expires_str,
+                    relative_stale_while_revalidate_str,
+                    relative_stale_if_error_str,
+                )
 
             # create the cache metadata records if it doesn't exist already
             except CacheMetaServiceExceptions.CacheNotFoundError:
-                cache_meta = await self.create(request_url, request_headers, relative_expires_str)
+                cache_meta = await self.create(
+                    request_url,
+                    request_headers,
+                    relative_expires_str,
+                    relative_stale_while_revalidate_str,
+                    relative_stale_if_error_str,
+                )
 
         # run the read method
         return cache_meta
@@ -0,0 +1,78 @@
+from collections import deque
+
+
+class CacheStats:
+    """Counters of how requests to the cache proxy are served, kept in memory since startup.
+
+    - `requests`: number of requests served by each outcome (hit, miss, stale, revalidated, relayed).
+    - `bytes`: bytes sent from the cache and downloaded from the upstream hosts.
+    - `evictions`: number of entries deleted by each reason.
+    - `fill_latency`: percentiles of the time to receive the upstream headers and to finish each download.
+    """
+
+    def __init__(self, max_samples: int = 1000):
+        self.requests: dict[str, int] = {}
+        self.negative_hits = 0
+        self.hot_hits = 0
+        self.bytes_from_cache = 0
+        self.bytes_from_upstream = 0
+        self.evictions: dict[str, int] = {}
+        self.evicted_bytes: dict[str, int] = {}
+        self.fill_errors = 0
+        self._response_times: deque[float] = deque(maxlen=max_samples)
+        self._fill_times: deque[float] = deque(maxlen=max_samples)
+
+    def record_request(self, outcome: str):
+        self.requests[outcome] = self.requests.get(outcome, 0) + 1
+
+    def record_eviction(self, reason: str, size: int | None):
+        self.evictions[reason] = self.evictions.get(reason, 0) + 1
+        self.evicted_bytes[reason] = self.evicted_bytes.get(reason, 0) + (size or 0)
+
+    def record_fill(self, response_time: float | None, fill_time: float | None):
+        """Registers the seconds a download took to receive the response headers and to complete"""
+        if response_time is not None:
+            self._response_times.append(response_time)
+        if fill_time is not None:
+            self._fill_times.append(fill_time)
+
+    def to_json(self):
+        total = sum(self.requests.values())
+        served_from_cache = sum(self.requests.get(outcome, 0) for outcome in ("hit", "stale", "revalidated"))
+        return {
+            "requests": {
+                **self.requests,
+                "total": total,
+                "hit_ratio": served_from_cache / total if total else None,
+                "hot_hits": self.hot_hits,
+                "negative_hits": self.negative_hits,
+            },
+            "bytes": {
+                "from_cache": self.bytes_from_cache,
+                "from_upstream": self.bytes_from_upstream,
+            },
+            "evictions": {
+                "count": self.evictions,
+                "bytes": self.evicted_bytes,
+            },
+            "fill_latency": {
+                "response": get_percentiles(self._response_times),
+                "total": get_percentiles(self._fill_times),
+                "errors": self.fill_errors,
+            },
+        }
+
+
+def get_percentiles(samples, percentiles: tuple[int, ...] = (50, 90, 99)) -> dict[str, float | None]:
+    """Returns the given percentiles of the samples using the nearest-rank method"""
+    samples = sorted(samples)
+    if not samples:
+        return {f"p{percentile}": None for percentile in percentiles}
+
+    return {
+        f"p{percentile}": samples[min(len(samples) - 1, max(0, round(percentile / 100 * len(samples)) - 1))]
+        for percentile in percentiles
+    }
+
+
+cache_stats = CacheStats()
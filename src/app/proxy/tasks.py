@@ -1,42 +1,124 @@
 import asyncio
 
-from sqlalchemy import select
+from sqlalchemy import select, func
 
 from ..db import SessionLocal
 from .models import CacheMeta
 from .services import CacheMetaService
-from .utils import get_dir_size
-from .constants import CACHE_DIR, MAX_CACHE_DIR_SIZE
+from .fills import active_fills
+from .usage import cache_usage
+from .stats import cache_stats
+from .eviction import get_eviction_policy, get_quota_key
+from .constants import (
+    MAX_CACHE_DIR_SIZE,
+    CACHE_EVICTION_POLICY,
+    CACHE_LOW_WATERMARK,
+    CACHE_CONTENT_TYPE_QUOTAS,
+)
 
 batch_delete_lock = asyncio.Lock()
 
+eviction_policy = get_eviction_policy(CACHE_EVICTION_POLICY)
+
+
+async def get_exceeding_quota_bytes(db) -> dict[str, int]:
+    """Returns the number of bytes that must be freed from each content type quota that has been reached"""
+    if not CACHE_CONTENT_TYPE_QUOTAS:
+        return {}
+
+    # sum the size of the cached files of each content type, counting the bodies shared by several records once
+    body_key = func.coalesce(CacheMeta.body_hash, CacheMeta.id)
+    stmt = select(CacheMeta.content_type, func.max(CacheMeta.cache_size)).group_by(CacheMeta.content_type, body_key)
+    results = await db.execute(stmt)
+    quota_sizes = {}
+    for content_type, size in results.all():
+        key = get_quota_key(content_type, CACHE_CONTENT_TYPE_QUOTAS)
+        if key is not None:
+            quota_sizes[key] = quota_sizes.get(key, 0) + (size or 0)
+
+    exceeding_bytes = {}
+    for key, size in quota_sizes.items():
+        quota = CACHE_CONTENT_TYPE_QUOTAS[key]
+        if size >= quota:
+            exceeding_bytes[key] = size - int(quota * CACHE_LOW_WATERMARK)
+
+    return exceeding_bytes
+
+
+async def get_body_reference_counts(db) -> dict[str, int]:
+    """Returns the number of records that reference each cached body"""
+    body_key = func.coalesce(CacheMeta.body_hash, CacheMeta.id)
+    results = await db.execute(select(body_key, func.count()).group_by(body_key))
+    return dict(results.all())
+
 
 async def delete_exceeding_caches():
-    # check if the size limit has been reached
-    if get_dir_size(CACHE_DIR) >= MAX_CACHE_DIR_SIZE:
+    async with batch_delete_lock:
         async with SessionLocal() as db:
-            cache_meta_service = CacheMetaService(db)
-            async with batch_delete_lock:
-                # query all cache metas ordered by the last time they were used
-                stmt = select(CacheMeta).order_by(CacheMeta.last_used_at)
-                results = await db.execute(stmt)
-
-                # mark cache metas to be deleted until the number of exceeding bytes goes bellow zero
-                exceeding_bytes = get_dir_size(CACHE_DIR) - MAX_CACHE_DIR_SIZE
-                tasks = []
-                for cache_meta in results.scalars().all():
-                    if exceeding_bytes < 0:
+            # check if any size limit has been reached
+            exceeding_quota_bytes = await get_exceeding_quota_bytes(db)
+            if cache_usage.size < MAX_CACHE_DIR_SIZE and not exceeding_quota_bytes:
+                return
+
+            # once a limit is reached, free space until the low watermark so this doesn't run on every tick
+            exceeding_bytes = 0
+            if cache_usage.size >= MAX_CACHE_DIR_SIZE:
+                exceeding_bytes = cache_usage.size - int(MAX_CACHE_DIR_SIZE * CACHE_LOW_WATERMARK)
+
+            # query all downloaded cache metas ordered by the eviction policy
+            stmt = select(CacheMeta).where(CacheMeta.is_downloaded.is_(True))
+            results = await db.execute(stmt)
+            entries = [cache_meta for cache_meta in results.scalars().all() if cache_meta.id not in active_fills]
+            entries = eviction_policy.sort(entries)
+
+            # a body shared by several records is only freed once all of them are deleted
+            body_references = await get_body_reference_counts(db)
+
+            def get_freed_size(cache_meta: CacheMeta) -> int:
+                body_key = cache_meta.body_hash or cache_meta.id
+                body_references[body_key] = body_references.get(body_key, 1) - 1
+                if body_references[body_key] > 0:
+                    return 0
+
+                return cache_meta.cache_size or 0
+
+            # mark cache metas to be deleted until the number of exceeding bytes of each quota goes bellow zero
+            marked = {}
+            reasons = {}
+            freed_sizes = {}
+            for key in exceeding_quota_bytes.keys():
+                for cache_meta in entries:
+                    if exceeding_quota_bytes[key] <= 0:
                         break
 
-                    # mark the cache to be deleted and subtract its size from the exceeding bytes
-                    tasks.append(cache_meta_service.delete(cache_meta.id))
-                    try:
-                        exceeding_bytes -= cache_meta.cache_size
-                    except TypeError:
-                        pass
+                    if cache_meta.id in marked or get_quota_key(cache_meta.content_type, CACHE_CONTENT_TYPE_QUOTAS) != key:
+                        continue
 
-                # delete all the marked downloads simultaneously
-                await asyncio.gather(*tasks)
+                    marked[cache_meta.id] = cache_meta
+                    reasons[cache_meta.id] = f"quota:{key}"
+                    freed_sizes[cache_meta.id] = get_freed_size(cache_meta)
+                    exceeding_quota_bytes[key] -= freed_sizes[cache_meta.id]
+                    exceeding_bytes -= freed_sizes[cache_meta.id]
+
+            # keep marking cache metas until the number of total exceeding bytes goes bellow zero
+            for cache_meta in entries:
+                if exceeding_bytes <= 0:
+                    break
+
+                if cache_meta.id not in marked:
+                    marked[cache_meta.id] = cache_meta
+                    reasons[cache_meta.id] = "size"
+                    freed_sizes[cache_meta.id] = get_freed_size(cache_meta)
+                    exceeding_bytes -= freed_sizes[cache_meta.id]
+
+            eviction_policy.on_evict(list(marked.values()))
+            for id, cache_meta in marked.items():
+                cache_stats.record_eviction(reasons[id], freed_sizes[id])
+
+            # delete all the marked downloads simultaneously
+            cache_meta_service = CacheMetaService(db)
+            tasks = [cache_meta_service.delete(id) for id in marked.keys()]
+            await asyncio.gather(*tasks)
 
 
 async def repeat_tasks(delay: float):
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+from .constants import CACHE_UNCACHEABLE_TTL
+
+
+class UncacheableKeys:
+    """Remembers for a while the cache keys whose responses are too big to be cached.
+
+    Requests for them are relayed straight from the host, instead of starting a download
+    that would only be aborted once the size limit is reached again.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = timedelta(seconds=ttl)
+        self._expires_at: dict[str, datetime] = {}
+
+    def add(self, hash: str):
+        self._expires_at[hash] = datetime.now() + self.ttl
+
+        # drop the keys that have already expired
+        now = datetime.now()
+        for key in [key for key, expires_at in self._expires_at.items() if now > expires_at]:
+            del self._expires_at[key]
+
+    def __contains__(self, hash: str) -> bool:
+        expires_at = self._expires_at.get(hash)
+        if expires_at is None:
+            return False
+
+        if datetime.now() > expires_at:
+            del self._expires_at[hash]
+            return False
+
+        return True
+
+    def to_json(self):
+        return {
+            "key_count": len(self._expires_at),
+            "ttl": self.ttl.total_seconds(),
+        }
+
+
+uncacheable_keys = UncacheableKeys(CACHE_UNCACHEABLE_TTL)
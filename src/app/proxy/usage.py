@@ -0,0 +1,38 @@
+import asyncio
+
+from .utils import get_dir_stats
+from .constants import CACHE_DIR
+
+
+class CacheUsage:
+    """Keeps a running total of the files and bytes stored on the cache directory.
+
+    The totals are updated as files are written and deleted, so checking the size of the cache
+    doesn't require scanning the whole directory. A full scan is only done by `reconcile`.
+    """
+
+    def __init__(self, dir_path: str):
+        self.dir_path = dir_path
+        self.size = 0
+        self.file_count = 0
+
+    def add(self, size: int, file_count: int = 1):
+        self.size += size
+        self.file_count += file_count
+
+    def remove(self, size: int, file_count: int = 1):
+        self.size = max(self.size - size, 0)
+        self.file_count = max(self.file_count - file_count, 0)
+
+    async def reconcile(self):
+        """Recomputes the totals from the files on the disk without blocking the event loop"""
+        self.file_count, self.size = await asyncio.to_thread(get_dir_stats, self.dir_path)
+
+    def to_json(self):
+        return {
+            "size": self.size,
+            "file_count": self.file_count,
+        }
+
+
+cache_usage = CacheUsage(CACHE_DIR)
@@ -1,14 +1,23 @@
-from urllib.parse import urlencode, urlparse
+from urllib.parse import urlencode, urlparse, urlsplit, urlunsplit, parse_qsl
+from contextlib import aclosing, asynccontextmanager
 from datetime import timedelta
 from pathlib import Path
+from typing import Awaitable, Callable
+import hashlib
 import asyncio
+import shutil
+import gzip
+import zlib
+import os
 import re
 
+import aiofiles
 import aiohttp
 from fastapi import Request
 from fastapi.exceptions import HTTPException
 
 from . import constants
+from .buffers import StreamBuffer
 
 
 def check_allowed_urls(url: str):
@@ -26,18 +35,119 @@ def check_allowed_urls(url: str):
     raise HTTPException(403, f"URL blocked by proxy: The URL '{url}' does not match any of the allowed hosts or regular expressions.")
 
 
-async def yield_chunks(request: Request, session: aiohttp.ClientSession, response: aiohttp.ClientResponse, chunk_size: int = 8192):
-    """Takes a `ClientSession` and `ClientResponse` object and yields chunks for a `StreamingResponse`.
+def parse_range_header(range_header: str | None) -> tuple[int, int | None] | None:
+    """Returns the first and last bytes of a single "bytes=start-end" range, or None for other kinds of ranges"""
+    if range_header is None:
+        return 0, None
 
-    Also closes both objects after a connection is closed or the files is fully streamed.
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d+)\s*-\s*(\d*)\s*", range_header)
+    if match is None:
+        return None
+
+    return int(match[1]), int(match[2]) if match[2] else None
+
+
+def get_validator(headers) -> str | None:
+    """Returns the strong ETag of a response, or its Last-Modified date, to send as an If-Range header"""
+    validator = headers.get("etag")
+    if validator is None or validator.startswith("W/"):
+        validator = headers.get("last-modified")
+
+    return validator
+
+
+def get_stream_reopener(
+    send_request: Callable[[dict], Awaitable[aiohttp.ClientResponse]],
+    headers: dict,
+    response: aiohttp.ClientResponse,
+) -> Callable[[int], Awaitable[aiohttp.ClientResponse]] | None:
+    """Returns a function that requests the rest of a streamed response from a given number of bytes already sent
+
+    `send_request` sends a GET request for the stream with the given headers.
+
+    Returns None if the response can't be resumed, either because the host doesn't support ranges
+    or because the original request has a range that can't be offset.
+    """
+    if response.status != 206 and response.headers.get("accept-ranges", "").lower() != "bytes":
+        return None
+
+    byte_range = parse_range_header(headers.get("range"))
+    if byte_range is None:
+        return None
+    start, end = byte_range
+
+    # only resume if the file hasn't changed since the stream started
+    validator = get_validator(response.headers)
+
+    async def reopen(offset: int) -> aiohttp.ClientResponse:
+        resume_start = start + offset
+        resume_headers = {**headers, "range": f"bytes={resume_start}-{end if end is not None else ''}"}
+        if validator is not None:
+            resume_headers["if-range"] = validator
+
+        resumed_response = await send_request(resume_headers)
+        content_range = resumed_response.headers.get("content-range", "")
+        if resumed_response.status != 206 or not content_range.startswith(f"bytes {resume_start}-"):
+            resumed_response.release()
+            raise aiohttp.ClientPayloadError(f"Host did not resume the stream from byte {resume_start}")
+
+        return resumed_response
+
+    return reopen
+
+
+async def iter_upstream(
+    response: aiohttp.ClientResponse,
+    reopen: Callable[[int], Awaitable[aiohttp.ClientResponse]] | None = None,
+):
+    """Yields the content of a response as it arrives
+
+    If `reopen` is given, upstream errors are retried by calling it with the number of bytes already yielded
+    and continuing with the response it returns. Releases the last response once done.
     """
-    # iterate through the response content yielding chunks
+    offset = 0
+    retries = 0
+    try:
+        while True:
+            try:
+                async for chunk in response.content.iter_any():
+                    offset += len(chunk)
+                    retries = 0
+                    yield chunk
+                return
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            # resume the stream from the last byte read, giving up after too many consecutive failures
+            response.release()
+            while True:
+                if reopen is None or retries >= constants.STREAM_RESUME_MAX_RETRIES:
+                    raise error
+
+                retries += 1
+                print(f"Stream interrupted after {offset} bytes, resuming (attempt {retries}): {error}")
+                await asyncio.sleep(constants.STREAM_RESUME_RETRY_DELAY * retries)
+                try:
+                    response = await reopen(offset)
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+
+    # cleanup
+    finally:
+        response.release()
+
+
+@asynccontextmanager
+async def handle_stream_errors():
+    """Turns the errors raised while a response is streamed into HTTP errors for the client"""
     try:
-        async for chunk in response.content.iter_chunked(chunk_size):
-            # check if client disconnects
-            if await request.is_disconnected():
-                break
-            yield chunk
+        yield
+
+    # errors of nested streams have already been handled
+    except HTTPException:
+        raise
 
     # triggered when client disconnects mid-stream
     except asyncio.CancelledError:
@@ -46,29 +156,219 @@ async def yield_chunks(request: Request, session: aiohttp.ClientSession, respons
 
     # handle host errors
     except Exception as e:
-        print(f"Streaming erro: {e}")
+        print(f"Streaming error: {e}")
         raise HTTPException(status_code=502, detail="Upstream CDN error")
 
-    # cleanup
+
+async def yield_chunks(
+    request: Request,
+    response: aiohttp.ClientResponse,
+    chunk_size: int = constants.STREAM_MAX_CHUNK_SIZE,
+    reopen: Callable[[int], Awaitable[aiohttp.ClientResponse]] | None = None,
+):
+    """Takes a `ClientResponse` object and yields chunks for a `StreamingResponse`.
+
+    The response is read by a separate task into a `StreamBuffer`, so the host is read while the client is
+    still receiving the previous chunks. Each chunk yielded joins everything buffered, up to `chunk_size` bytes.
+    A third task watches for the client disconnecting, so the stream loop doesn't have to check it on every chunk.
+
+    Also releases the response after a connection is closed or the files is fully streamed,
+    so its connection can go back to the pool.
+
+    If `reopen` is given, upstream errors are retried by calling it with the number of bytes already sent
+    and splicing the response it returns into the same stream, so short hiccups aren't noticed by the client.
+    """
+    buffer = StreamBuffer(constants.STREAM_BUFFER_SIZE)
+
+    async def read_upstream():
+        try:
+            # move the response content to the buffer as soon as it arrives
+            async with aclosing(iter_upstream(response, reopen)) as chunks:
+                async for chunk in chunks:
+                    if not await buffer.put(chunk):
+                        return
+
+            await buffer.close()
+
+        except Exception as e:
+            await buffer.close(e)
+
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(constants.STREAM_DISCONNECT_CHECK_INTERVAL)
+
+        await buffer.close()
+
+    reader_task = asyncio.create_task(read_upstream())
+    watcher_task = asyncio.create_task(watch_disconnect())
+
+    # send the buffered content to the client
+    try:
+        async with handle_stream_errors():
+            while (chunk := await buffer.get(chunk_size)) is not None:
+                yield chunk
+
+    # stop reading from the host if the stream ends early
     finally:
-        response.release()
-        await session.close()
+        reader_task.cancel()
+        watcher_task.cancel()
+
+
+def normalize_url(url: str) -> str:
+    """Returns the canonical form of an url
+
+    The scheme and host are lowercased, default ports and fragments are removed and the query parameters are sorted.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
 
+    # rebuild the host without the port if it's the default one
+    netloc = parts.hostname or ""
+    if parts.port is not None and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        netloc = f"{netloc}:{parts.port}"
+    if parts.username is not None:
+        credentials = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{credentials}@{netloc}"
 
-def add_proxy_to_hls_parts(m3u8_content: str, headers: dict | None = None):
-    if headers is None:
-        headers = {}
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
 
-    lines = m3u8_content.split("\n")
-    for i, line in enumerate(lines):
-        url_matches = re.match(r"https?://[a-zA-Z0-9.-]+(?:\.[a-zA-Z]{2,})(:\d+)?(/[^\s]*)?", line)
-        if url_matches:
-            # update url to use the local proxy
-            url = url_matches[0]
-            query = urlencode({"url": url, "headers": headers})
-            lines[i] = f"?{query}"
 
-    return "\n".join(lines)
+def normalize_request_headers(headers: dict) -> dict:
+    """Returns the headers that can change the upstream response, with lowercase names and sorted by them"""
+    normalized_headers = {}
+    for key, value in headers.items():
+        key = key.strip().lower()
+        if key not in constants.CACHE_KEY_IGNORED_HEADERS:
+            normalized_headers[key] = str(value).strip()
+
+    return dict(sorted(normalized_headers.items()))
+
+
+def get_cache_hash(request_url: str, request_headers: dict) -> str:
+    """Returns the hash that identifies the cached response of a request
+
+    Both the url and the headers are normalized first, so equivalent requests share the same cached response.
+    """
+    hash = hashlib.md5()
+    hash.update(f"{normalize_url(request_url)} {normalize_request_headers(request_headers)}".encode())
+    return hash.hexdigest()
+
+
+def get_cache_response_headers(headers: dict) -> dict:
+    """Returns a copy of the headers of a cached response that can be sent alongside the cached file"""
+    # make all the keys lowercase
+    response_headers = {key.lower(): headers[key] for key in headers.keys()}
+
+    # remove "content-encoding" header and also "content-length" if the former is removed succesfully
+    # this is done to avoid mismatch between the original encoding/size and the one from the cached file
+    try:
+        response_headers.pop("content-encoding")
+        response_headers.pop("content-length")
+    except KeyError:
+        pass
+
+    return response_headers
+
+
+def get_media_type(headers: dict) -> str | None:
+    """Returns the lowercase media type of a "content-type" header without its parameters"""
+    for key in headers.keys():
+        if key.lower() == "content-type":
+            return headers[key].split(";")[0].strip().lower()
+
+    return None
+
+
+def is_success_status(status: int | None) -> bool:
+    """Returns whether a status code is a 2xx one"""
+    return status is not None and 199 < status < 300
+
+
+def get_negative_ttl(status: int) -> str | None:
+    """Returns how long an error response with the given status should be cached, if at all"""
+    ttl = constants.CACHE_NEGATIVE_TTLS.get(str(status))
+    if ttl is None:
+        ttl = constants.CACHE_NEGATIVE_TTLS.get(f"{status // 100}xx")
+
+    return ttl
+
+
+def is_compressible(content_type: str | None) -> bool:
+    """Returns whether a cached file of the given media type should be stored compressed"""
+    if content_type is None:
+        return False
+
+    return any(content_type.startswith(prefix) for prefix in constants.CACHE_COMPRESSED_CONTENT_TYPES)
+
+
+def accepts_encoding(accept_encoding: str | None, encoding: str) -> bool:
+    """Returns whether an "accept-encoding" header allows responses with the given content encoding"""
+    if accept_encoding is None:
+        return False
+
+    for part in accept_encoding.split(","):
+        name, *params = [value.strip() for value in part.split(";")]
+        if name.lower() not in (encoding, "*"):
+            continue
+
+        # encodings can be explicitly refused with "q=0"
+        for param in params:
+            if param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                return False
+
+        return True
+
+    return False
+
+
+def compress_file(src_path: str, dst_path: str) -> int:
+    """Writes a gzipped copy of a file and returns its size in bytes"""
+    with open(src_path, "rb") as src, gzip.open(dst_path, "wb", compresslevel=constants.CACHE_COMPRESSION_LEVEL) as dst:
+        shutil.copyfileobj(src, dst, constants.CACHE_CHUNK_SIZE)
+
+    return get_file_size(dst_path)
+
+
+async def iter_decompressed_file(file_path: str, chunk_size: int = 64 * 1024):
+    """Yields the decompressed content of a gzipped file"""
+    decompressor = zlib.decompressobj(wbits=31)
+    async with aiofiles.open(file_path, "rb") as file:
+        while chunk := await file.read(chunk_size):
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def get_conditional_headers(headers: dict) -> dict:
+    """Returns the headers needed to revalidate a cached response with the validators on its `headers`"""
+    conditional_headers = {}
+    for key in headers.keys():
+        match key.lower():
+            case "etag":
+                conditional_headers.update({"if-none-match": headers[key]})
+            case "last-modified":
+                conditional_headers.update({"if-modified-since": headers[key]})
+
+    return conditional_headers
+
+
+def merge_revalidated_headers(headers: dict, new_headers: dict) -> dict:
+    """Returns the headers of a cached response updated with the validators and freshness headers of a 304 response"""
+    updatable_keys = ("etag", "last-modified", "cache-control", "expires", "date")
+    merged_headers = headers.copy()
+    for key, value in new_headers.items():
+        if key.lower() in updatable_keys:
+            # drop the previous value regardless of the casing of its key
+            for old_key in [old_key for old_key in merged_headers.keys() if old_key.lower() == key.lower()]:
+                merged_headers.pop(old_key)
+            merged_headers[key] = value
+
+    return merged_headers
 
 
 def str_to_timedelta(string: str):
@@ -99,9 +399,73 @@ def str_to_timedelta(string: str):
     return timedelta(**args)
 
 
-def get_dir_size(dir_path: str):
-    """Returns the size in bytes of all the folders in a directory and its subdirectories combined"""
-    return sum(file.stat().st_size for file in Path(dir_path).rglob("*"))
+def get_cache_path(hash: str) -> str:
+    """Returns the path of a cached file, sharded into subdirectories named after the first characters of its hash"""
+    return os.path.join(constants.CACHE_DIR, hash[: constants.CACHE_SHARD_LENGTH], hash)
+
+
+def get_body_path(body_hash: str | None, hash: str) -> str:
+    """Returns the path of the file holding the body of a cached response
+
+    Bodies are stored by the hash of their content, so identical responses share the same file. Files
+    cached before that are still named after the hash of their record, which is used when `body_hash` is null.
+    """
+    return get_cache_path(body_hash or hash)
+
+
+def get_temp_path(path: str) -> str:
+    """Returns the path of the temporary file used while `path` is written"""
+    return f"{path}.tmp"
+
+
+def migrate_flat_cache_dir():
+    """Moves the cached files saved directly on the cache directory by older versions into their shards
+
+    Also removes temporary files left behind by interrupted downloads.
+    """
+    if not os.path.isdir(constants.CACHE_DIR):
+        return
+
+    for entry in os.scandir(constants.CACHE_DIR):
+        if not entry.is_file():
+            continue
+
+        if re.fullmatch(r"[0-9a-f]{32}", entry.name):
+            cache_path = get_cache_path(entry.name)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            os.replace(entry.path, cache_path)
+
+        elif entry.name.endswith(".tmp"):
+            os.remove(entry.path)
+
+
+def remove_files(paths: list[str]) -> tuple[int, int]:
+    """Removes the given files, ignoring the missing ones, and returns how many were removed and their combined size"""
+    file_count = 0
+    size = 0
+    for path in paths:
+        try:
+            file_size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+
+        file_count += 1
+        size += file_size
+
+    return file_count, size
+
+
+def get_dir_stats(dir_path: str) -> tuple[int, int]:
+    """Returns the number of files in a directory and its subdirectories and their combined size in bytes"""
+    file_count = 0
+    size = 0
+    for file in Path(dir_path).rglob("*"):
+        if file.is_file():
+            file_count += 1
+            size += file.stat().st_size
+
+    return file_count, size
 
 
 def get_file_size(file_path: str):
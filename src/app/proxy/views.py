@@ -1,17 +1,47 @@
+from functools import partial
+from typing import Awaitable, Callable
 from urllib.parse import urlparse
 import asyncio
+import gzip
 import ast
-import os
 
+import aiofiles
 import aiohttp
 from fastapi import Request
+from fastapi.exceptions import HTTPException
 from fastapi.responses import StreamingResponse, FileResponse, Response
+from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .utils import check_allowed_urls, add_proxy_to_hls_parts, yield_chunks
-from .services import CacheMetaService, CacheMetaServiceExceptions
+from src.utils.http_client import shared_client
+from .utils import (
+    check_allowed_urls,
+    yield_chunks,
+    get_cache_response_headers,
+    get_cache_hash,
+    get_body_path,
+    get_stream_reopener,
+    parse_range_header,
+    get_media_type,
+    accepts_encoding,
+    is_success_status,
+    iter_decompressed_file,
+)
+from .services import CacheMetaService, CacheMetaServiceExceptions, stream_client
+from .fills import active_fills
+from .access import access_tracker
+from .hot_cache import hot_cache
+from .uncacheable import uncacheable_keys
+from .stats import cache_stats
+from .hls import HLSRewriter, iter_rewritten_playlist
+from .prefetch import hls_prefetcher
+from .coalesce import stream_coalescer, yield_shared_chunks
+from .ranges import RangeCacheEntry, range_cache, yield_cached_range
+from .metadata import stream_metadata_cache
 from .tasks import delete_exceeding_caches
-from .constants import CACHE_DIR, HLS_CONTENT_TYPE_HEADERS
+from .models import CacheMeta
+from .usage import cache_usage
+from .constants import HLS_CONTENT_TYPE_HEADERS, MAX_CACHE_DIR_SIZE
 
 cache_proxy_lock = asyncio.Lock()
 
@@ -20,6 +50,33 @@ async def stream_proxy(request: Request, url: str, headers: dict, request_header
     # check if the url host is on the allow list
     check_allowed_urls(url)
 
+    # keep the headers for the host to send them along with the parts of hls streams
+    hls_headers = dict(headers)
+
+    # serve segments of hls streams that have been downloaded ahead of the player
+    if "range" not in request_headers.keys():
+        segment = await hls_prefetcher.get(url)
+        if segment is not None:
+            return Response(segment.body, segment.status, headers=segment.headers)
+
+    # skip the redirects of urls whose final url is known, following them again if it has expired
+    stream_key = get_cache_hash(url, hls_headers)
+    send_request = partial(stream_metadata_cache.request, stream_key, url)
+
+    # answer the probes of progressive streams from their cached head and tail
+    range_entry = range_cache.get(stream_key)
+    if range_entry is not None:
+        range_response = get_cached_range_response(
+            request,
+            range_entry,
+            request_headers.get("range"),
+            send_request,
+            hls_headers,
+        )
+        if range_response is not None:
+            range_cache.hits += 1
+            return range_response
+
     # get headers relevant to the host
     if "range" in request_headers.keys():
         headers.update({"range": request_headers["range"]})
@@ -27,58 +84,265 @@ async def stream_proxy(request: Request, url: str, headers: dict, request_header
     if "accept" in request_headers.keys():
         headers.update({"accept": request_headers["accept"]})
 
-    # start session and request outside of a context managers
-    session = aiohttp.ClientSession()
-    response = await session.get(url, headers=headers)
+    # join an identical stream that is already being read from the host
+    key = get_cache_hash(url, headers)
+    shared_stream = stream_coalescer.get(key)
+    if shared_stream is not None:
+        subscriber = await shared_stream.subscribe()
+        if subscriber is not None:
+            return StreamingResponse(
+                yield_shared_chunks(request, subscriber),
+                headers=get_stream_response_headers(shared_stream.response),
+                status_code=shared_stream.response.status,
+            )
 
-    # get response header as a dict
-    response_headers = {key.lower(): response.headers.get(key) for key in response.headers.keys()}
+    # let identical requests made while waiting for the host share this stream
+    shared_stream = stream_coalescer.create(key)
 
-    # remove host's CORS restrictions from response headers
-    if "access-control-allow-origin" in response_headers.keys():
-        response_headers.update({"access-control-allow-origin": "*"})
+    # send the request through the shared connection pool outside of a context manager
+    try:
+        response = await send_request(headers)
+    except BaseException:
+        shared_stream.abort()
+        raise
 
-    # modify hls streams to use local proxy
-    if response_headers["content-type"] in HLS_CONTENT_TYPE_HEADERS:
-        updated_content = add_proxy_to_hls_parts(await response.text())
-        return Response(
-            updated_content,
+    stream_metadata_cache.add(stream_key, response)
+    response_headers = get_stream_response_headers(response)
+
+    # modify hls streams to use local proxy, rewriting them as they're received
+    if get_media_type(response_headers) in HLS_CONTENT_TYPE_HEADERS:
+        shared_stream.abort()
+
+        # the rewritten playlist has a different size and aiohttp has already decoded it
+        response_headers.pop("content-length", None)
+        response_headers.pop("content-encoding", None)
+
+        return StreamingResponse(
+            iter_prefetched_playlist(response, HLSRewriter(str(response.url), hls_headers), url, hls_headers),
             response.status,
             headers=response_headers,
         )
 
+    # streams are only shared if they can be resumed, so clients falling behind can continue on their own
+    reopen = get_stream_reopener(send_request, headers, response)
+    if reopen is not None:
+        chunks = yield_shared_chunks(request, shared_stream.start(response, reopen))
     else:
-        # return stream
+        shared_stream.abort()
+        chunks = yield_chunks(request, response)
+
+    # keep the head of progressive streams that start at the first byte, and prefetch their tail
+    range_entry = range_cache.add(stream_key, send_request, hls_headers, response.status, response_headers)
+    if range_entry is not None:
+        chunks = range_cache.iter_recording_head(range_entry, chunks)
+
+    # return stream
+    return StreamingResponse(
+        chunks,
+        headers=response_headers,
+        status_code=response.status,
+    )
+
+
+def get_cached_range_response(
+    request: Request,
+    entry: RangeCacheEntry,
+    range_header: str | None,
+    send_request: Callable[[dict], Awaitable[aiohttp.ClientResponse]],
+    headers: dict,
+) -> Response | None:
+    """Returns a response for the requested range if it's cached or starts on the cached head, or None otherwise"""
+    byte_range = parse_range_header(range_header)
+    if byte_range is None or byte_range[0] >= entry.size:
+        return None
+
+    start, end = byte_range
+    end = entry.size - 1 if end is None else min(end, entry.size - 1)
+    if end < start:
+        return None
+
+    # requests without a range get the whole file
+    status = 200 if range_header is None else 206
+    response_headers = entry.get_response_headers(start, end, range_header is not None)
+
+    cached_bytes = entry.get_bytes(start, end)
+    if cached_bytes is not None:
+        return Response(cached_bytes, status, headers=response_headers)
+
+    # send the cached head right away while the rest is requested from the host
+    if start < len(entry.head):
         return StreamingResponse(
-            yield_chunks(request, session, response),
+            yield_cached_range(request, entry, start, end, send_request, headers),
+            status,
             headers=response_headers,
-            status_code=response.status,
         )
 
+    return None
 
-# TODO: block big files from being cached
-async def cache_proxy(url: str, headers: dict, expires: str | None, db: AsyncSession):
+
+async def stream_proxy_head(url: str, headers: dict):
     # check if the url host is on the allow list
     check_allowed_urls(url)
 
+    # answer from the metadata of the last request for the same stream, or ask the host for it
+    key = get_cache_hash(url, headers)
+    metadata = stream_metadata_cache.get(key)
+    status = 200
+    if metadata is None:
+        try:
+            status, metadata = await stream_metadata_cache.fetch(key, url, headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error requesting the metadata of '{url}': {e}")
+            raise HTTPException(status_code=502, detail="Upstream CDN error")
+
+    if metadata is None:
+        return Response(status_code=status)
+
+    # don't report an empty body when the size of the stream is unknown
+    response_headers = metadata.get_response_headers()
+    response = Response(status_code=status, headers=response_headers)
+    if "content-length" not in response_headers.keys():
+        del response.headers["content-length"]
+
+    return response
+
+
+def get_stream_response_headers(response: aiohttp.ClientResponse) -> dict:
+    # get response header as a dict
+    response_headers = {key.lower(): response.headers.get(key) for key in response.headers.keys()}
+
+    # remove host's CORS restrictions from response headers
+    if "access-control-allow-origin" in response_headers.keys():
+        response_headers.update({"access-control-allow-origin": "*"})
+
+    return response_headers
+
+
+async def iter_prefetched_playlist(response, rewriter: HLSRewriter, playlist_url: str, headers: dict):
+    """Yields the rewritten playlist, then registers its segments so they're prefetched once playback starts"""
+    async for line in iter_rewritten_playlist(response, rewriter):
+        yield line
+
+    hls_prefetcher.add_playlist(playlist_url, rewriter.segment_urls, headers)
+
+
+async def cache_proxy(
+    request: Request,
+    url: str,
+    headers: dict,
+    expires: str | None,
+    stale_while_revalidate: str | None,
+    stale_if_error: str | None,
+    request_headers: dict,
+    db: AsyncSession,
+):
+    # check if the url host is on the allow list
+    check_allowed_urls(url)
+
+    # serve small and frequently used files straight from memory
+    hash = get_cache_hash(url, headers)
+    hot_entry = hot_cache.get(hash)
+    if hot_entry is not None:
+        access_tracker.touch(hash)
+        cache_stats.record_request("hit")
+        cache_stats.hot_hits += 1
+        cache_stats.bytes_from_cache += len(hot_entry.body)
+        if not is_success_status(hot_entry.status):
+            cache_stats.negative_hits += 1
+        return get_encoded_response(
+            hot_entry.body,
+            hot_entry.status,
+            hot_entry.headers,
+            hot_entry.content_encoding,
+            request_headers,
+        )
+
+    # relay files that are too big to be cached straight from the host
+    if hash in uncacheable_keys:
+        cache_stats.record_request("relayed")
+        return await stream_proxy(request, url, dict(headers), request_headers)
+
     # read or create the cache metadata record
     cache_meta_service = CacheMetaService(db)
-    cache_meta = await cache_meta_service.create_or_read_from_url(url, headers, expires)
+    try:
+        cache_meta = await cache_meta_service.create_or_read_from_url(
+            url,
+            headers,
+            expires,
+            stale_while_revalidate,
+            stale_if_error,
+        )
+    except CacheMetaServiceExceptions.EntryTooLargeError:
+        cache_stats.record_request("relayed")
+        return await stream_proxy(request, url, dict(headers), request_headers)
+
+    # stream the file to the user while it's still being downloaded
+    # files refreshed in the background are still marked as downloaded and their stale version is served instead
+    fill = active_fills.get(cache_meta.id)
+    if fill is not None and not cache_meta.is_downloaded:
+        await fill.wait_for_response()
+        if isinstance(fill.error, CacheMetaServiceExceptions.EntryTooLargeError):
+            return await stream_proxy(request, url, dict(headers), request_headers)
+        if fill.error is not None:
+            raise fill.error
+
+        # downloads that have already finished are served from the published file instead
+        if not fill.is_finished:
+            return StreamingResponse(
+                iter_fill_chunks(request, fill.iter_chunks(), url, headers),
+                status_code=fill.status,
+                headers=get_cache_response_headers(fill.headers),
+            )
+
+    # load the data saved by a download that has just finished
+    if not cache_meta.is_downloaded:
+        await db.refresh(cache_meta)
 
     # get the path to the cached file
-    cache_path = os.path.join(CACHE_DIR, cache_meta.id)
+    cache_path = get_body_path(cache_meta.body_hash, cache_meta.id)
 
-    # get response headers and make all the keys lowercase
-    response_headers = ast.literal_eval(cache_meta.response_headers)
-    response_headers = {key.lower(): response_headers[key] for key in response_headers.keys()}
+    # get the headers of the cached response
+    response_headers = get_cache_response_headers(ast.literal_eval(cache_meta.response_headers))
 
-    # remove "content-encoding" header and also "content-length" if the former is removed succesfully
-    # this is done to avoid mismatch between the original encoding/size and the one from the cached file
-    try:
-        response_headers.pop("content-encoding")
-        response_headers.pop("content-length")
-    except KeyError:
-        pass
+    cache_stats.bytes_from_cache += cache_meta.cache_size or 0
+    if not is_success_status(cache_meta.response_status):
+        cache_stats.negative_hits += 1
+
+    # keep small files in memory for the next requests
+    if cache_meta.cache_size is not None and cache_meta.cache_size <= hot_cache.max_entry_size:
+        async with aiofiles.open(cache_path, "rb") as file:
+            body = await file.read()
+
+        hot_cache.put(
+            cache_meta.id,
+            body,
+            cache_meta.response_status,
+            response_headers,
+            cache_meta.expires_at,
+            cache_meta.content_encoding,
+        )
+        return get_encoded_response(
+            body,
+            cache_meta.response_status,
+            response_headers,
+            cache_meta.content_encoding,
+            request_headers,
+        )
+
+    # compressed files are sent as they are to clients that accept them and decompressed on the fly otherwise
+    if cache_meta.content_encoding is not None:
+        if accepts_encoding(request_headers.get("accept-encoding"), cache_meta.content_encoding):
+            return FileResponse(
+                cache_path,
+                status_code=cache_meta.response_status,
+                headers=get_compressed_response_headers(response_headers, cache_meta.content_encoding),
+            )
+
+        return StreamingResponse(
+            iter_decompressed_file(cache_path),
+            status_code=cache_meta.response_status,
+            headers=response_headers,
+        )
 
     # send de cached request and file to the user
     # this will return the original response even if it has an error status code
@@ -87,3 +351,91 @@ async def cache_proxy(url: str, headers: dict, expires: str | None, db: AsyncSes
         status_code=cache_meta.response_status,
         headers=response_headers,
     )
+
+
+async def clear_cache(host: str | None, older_than: str | None, content_type: str | None, db: AsyncSession):
+    # delete the matching records and files in bulk
+    cache_meta_service = CacheMetaService(db)
+    return await cache_meta_service.purge(host, older_than, content_type)
+
+
+async def cache_stats_overview(top: int, db: AsyncSession):
+    # write the pending accesses so the hit counts are up to date
+    await access_tracker.flush()
+
+    top_by_size = await db.scalars(select(CacheMeta).order_by(CacheMeta.cache_size.desc()).limit(top))
+    top_by_hits = await db.scalars(select(CacheMeta).order_by(CacheMeta.hit_count.desc()).limit(top))
+    return {
+        **cache_stats.to_json(),
+        "usage": {
+            **cache_usage.to_json(),
+            "max_size": MAX_CACHE_DIR_SIZE,
+            "record_count": await db.scalar(select(func.count()).select_from(CacheMeta)),
+        },
+        "hot_cache": hot_cache.to_json(),
+        "uncacheable": uncacheable_keys.to_json(),
+        "active_fills": len(active_fills),
+        "top_by_size": [cache_meta.to_json() for cache_meta in top_by_size],
+        "top_by_hits": [cache_meta.to_json() for cache_meta in top_by_hits],
+        "upstream": {
+            "cache": shared_client.get_stats(),
+            "stream": stream_client.get_stats(),
+        },
+        "stream_proxy": {
+            "hls_prefetch": hls_prefetcher.to_json(),
+            "coalescing": stream_coalescer.to_json(),
+            "range_cache": range_cache.to_json(),
+            "metadata": stream_metadata_cache.to_json(),
+        },
+    }
+
+
+async def iter_fill_chunks(request: Request, chunks, url: str, headers: dict):
+    """Yields the chunks of a file being cached
+
+    If the file turns out to be too big to be cached, the rest of it is relayed straight from the host.
+    """
+    offset = 0
+    try:
+        async for chunk in chunks:
+            offset += len(chunk)
+            yield chunk
+        return
+
+    except CacheMetaServiceExceptions.EntryTooLargeError:
+        pass
+
+    # request only the missing bytes, or skip the ones already sent if the host doesn't support ranges
+    response = await stream_client.session.get(url, headers={**headers, "range": f"bytes={offset}-"})
+    skip = offset if response.status != 206 else 0
+    async for chunk in yield_chunks(request, response):
+        if skip >= len(chunk):
+            skip -= len(chunk)
+            continue
+
+        yield chunk[skip:]
+        skip = 0
+
+
+def get_compressed_response_headers(headers: dict, content_encoding: str) -> dict:
+    """Returns the headers of a cached response sent with its body still compressed"""
+    headers = {key: value for key, value in headers.items() if key != "content-length"}
+    headers.update({"content-encoding": content_encoding, "vary": "accept-encoding"})
+    return headers
+
+
+def get_encoded_response(
+    body: bytes,
+    status: int,
+    headers: dict,
+    content_encoding: str | None,
+    request_headers: dict,
+) -> Response:
+    """Returns a response for a cached body, decompressing it if the client doesn't accept its encoding"""
+    if content_encoding is None:
+        return Response(body, status_code=status, headers=headers)
+
+    if accepts_encoding(request_headers.get("accept-encoding"), content_encoding):
+        return Response(body, status_code=status, headers=get_compressed_response_headers(headers, content_encoding))
+
+    return Response(gzip.decompress(body), status_code=status, headers=headers)
@@ -5,7 +5,8 @@ import typing
 import re
 
 from bs4 import BeautifulSoup
-import aiohttp
+
+from src.utils.http_client import shared_client
 
 
 class IMDB:
@@ -174,29 +175,24 @@ async def get_media(
         raise AttributeError(msg)
 
     # get media page
-    async with aiohttp.ClientSession() as session:
-        imdb_url = f"https://www.imdb.com/title/{id}/"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:137.0) Gecko/20100101 Firefox/137.0",
-            "Accept-Language": lang_header,
-        }
+    imdb_url = f"https://www.imdb.com/title/{id}/"
+    headers = {"Accept-Language": lang_header}
 
-        async with session.get(imdb_url, headers=headers) as response:
-            if response.status != 200:
-                msg = f"Bad status code when requesting IMDb page. Expected '200', got '{response.status}'"
-                raise Exception(msg)
+    async with shared_client.session.get(imdb_url, headers=headers) as response:
+        if response.status != 200:
+            msg = f"Bad status code when requesting IMDb page. Expected '200', got '{response.status}'"
+            raise Exception(msg)
 
-            imdb_html = BeautifulSoup(await response.text(), "html.parser")
+        imdb_html = BeautifulSoup(await response.text(), "html.parser")
 
     return IMDB(id, lang, html=imdb_html)
 
 
 async def search(term: str, lang: str, ids_only: bool = False) -> list[IMDB] | list[str]:
     url = f"https://v3.sg.media-imdb.com/suggestion/x/{term}.json"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as res:
-            results = await res.json()
-            results = results["d"]
+    async with shared_client.session.get(url) as res:
+        results = await res.json()
+        results = results["d"]
 
     # return only the ids of the results
     if ids_only:
@@ -1,10 +1,10 @@
 import asyncio
 
-import aiohttp
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_
 
+from src.utils.http_client import shared_client
 from . import scraper as imdb
 from .models import TranslatableMovieInfo, Movie, TranslatableSeriesInfo, Series, Episode
 from .schemas.movie import MovieCreate, TranslatableMovieInfoCreate
@@ -275,9 +275,8 @@ class MediaService:
 
                         # get episode data from stremio's api
                         # TODO: update this to scrape data from imdb
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(f"https://cinemeta-live.strem.io/meta/series/{media_data.imdb_code}.json") as response:
-                                stremio_info = await response.json()
+                        async with shared_client.session.get(f"https://cinemeta-live.strem.io/meta/series/{media_data.imdb_code}.json") as response:
+                            stremio_info = await response.json()
 
                         # create a record on the database for each episode
                         try:
@@ -5,8 +5,8 @@ from typing import Literal, Any
 
 from pydantic import BaseModel, field_validator
 from bs4 import BeautifulSoup
-import aiohttp
 
+from src.utils.http_client import shared_client
 from .. import imdb
 from .exceptions import *
 
@@ -28,13 +28,12 @@ async def search(search_term: str) -> list[PobreflixResult]:
     search_url = f"{search_url}?{query_params}"
     headers = {"referer": BASE_URL}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(search_url, headers=headers) as response:
-            if response.status != 200:
-                msg = f"Unexpected status code when fetching page. Expected '200', got '{response.status}'"
-                raise UnexpectedStatusCode(msg)
+    async with shared_client.session.get(search_url, headers=headers) as response:
+        if response.status != 200:
+            msg = f"Unexpected status code when fetching page. Expected '200', got '{response.status}'"
+            raise UnexpectedStatusCode(msg)
 
-            page_html = BeautifulSoup(await response.text(), "html.parser")
+        page_html = BeautifulSoup(await response.text(), "html.parser")
 
     # get all search results
     results = page_html.find_all("div", {"id": "collview"})
@@ -86,9 +85,8 @@ async def get_media_pages(imdb_id: str) -> dict:
 
 
 async def get_sources(url: str):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            html = BeautifulSoup(await response.text(), "html.parser")
+    async with shared_client.session.get(url) as response:
+        html = BeautifulSoup(await response.text(), "html.parser")
 
     sources = {}
     sources_ul = html.find("ul", {"id": "baixar_menu"})
@@ -104,11 +102,10 @@ async def get_sources(url: str):
 
 
 async def get_epiosode_url(url: str, season: int, episode: int) -> str | None:
-    async with aiohttp.ClientSession() as session:
-        # get page of the desired season
-        season_url = f"{url}?temporada={season}"
-        async with session.get(season_url) as season_response:
-            season_html = BeautifulSoup(await season_response.text(), "html.parser")
+    # get page of the desired season
+    season_url = f"{url}?temporada={season}"
+    async with shared_client.session.get(season_url) as season_response:
+        season_html = BeautifulSoup(await season_response.text(), "html.parser")
 
     # get url of the desired episode
     a_elements = season_html.find("ul", {"id": "listagem"}).find_all("a")
@@ -2,9 +2,9 @@
 
 import re
 
-import aiohttp
 from bs4 import BeautifulSoup
 
+from src.utils.http_client import shared_client
 from src.utils.stremio import StremioStream
 from .exceptions import *
 
@@ -12,14 +12,12 @@ from .exceptions import *
 class StreamtapeStream:
     @classmethod
     async def get(cls, streamtape_url: str) -> StremioStream:
-        async with aiohttp.ClientSession() as session:
-            # get video page
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:137.0) Gecko/20100101 Firefox/137.0",
-                "Referer": "https://pobreflixtv.love/",
-            }
-            response = await session.get(streamtape_url, headers=headers)
+        session = shared_client.session
 
+        # get video page
+        headers = {"Referer": "https://pobreflixtv.love/"}
+        response = await session.get(streamtape_url, headers=headers)
+        try:
             # redirect if necessary
             if "window.location.href" in await response.text():
                 matches = re.findall(r"window.location.href *= *\"(.+)\" *;?", await response.text())
@@ -33,6 +31,7 @@ class StreamtapeStream:
                 raise UnexpectedStatusCode(msg)
 
             html = BeautifulSoup(await response.text(), "html.parser")
+        finally:
             response.release()
 
         # find script element containing the stream link
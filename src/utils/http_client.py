@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+import asyncio
+
+from yarl import URL
+import aiohttp
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:137.0) Gecko/20100101 Firefox/137.0"
+
+
+class HTTPClient:
+    """Keeps a single `aiohttp.ClientSession` alive and shares it between every request made through it.
+
+    The session is created lazily on the running event loop, so idle connections (and their
+    TCP/TLS handshakes) are reused by later requests to the same host instead of being thrown away.
+    The number of requests, new connections and reused connections is counted per upstream host.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 15,
+        ttl_dns_cache: int | None = 10,
+        timeout: aiohttp.ClientTimeout | None = None,
+        headers: dict | None = None,
+    ):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._ttl_dns_cache = ttl_dns_cache
+        self._timeout = timeout
+        self._headers = headers
+
+        self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+        self._host_stats: dict[str, dict[str, int]] = {}
+
+    def _count(self, host: str | None, key: str):
+        if host is None:
+            return
+
+        stats = self._host_stats.setdefault(host, {"requests": 0, "new_connections": 0, "reused_connections": 0})
+        stats[key] += 1
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            ctx.host = params.url.host
+            self._count(ctx.host, "requests")
+
+        async def on_request_redirect(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestRedirectParams):
+            # the following hop may go to a different host
+            location = params.response.headers.get("location")
+            if location is not None:
+                ctx.host = params.url.join(URL(location)).host
+                self._count(ctx.host, "requests")
+
+        async def on_connection_create_end(session, ctx: SimpleNamespace, params):
+            self._count(getattr(ctx, "host", None), "new_connections")
+
+        async def on_connection_reuseconn(session, ctx: SimpleNamespace, params):
+            self._count(getattr(ctx, "host", None), "reused_connections")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_redirect.append(on_request_redirect)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+        return trace_config
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Returns the shared session, creating a new one if it is closed or belongs to another event loop"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+                ttl_dns_cache=self._ttl_dns_cache,
+            )
+
+            kwargs = {
+                "connector": connector,
+                "headers": self._headers,
+                "trace_configs": [self._trace_config()],
+            }
+            if self._timeout is not None:
+                kwargs.update({"timeout": self._timeout})
+
+            self._session = aiohttp.ClientSession(**kwargs)
+            self._loop = loop
+
+        return self._session
+
+    def get_stats(self) -> dict[str, dict[str, int]]:
+        """Returns the request and connection counters of each upstream host"""
+        return {host: stats.copy() for host, stats in self._host_stats.items()}
+
+    async def start(self):
+        """Opens the connection pool ahead of the first request"""
+        self.session
+
+    async def close(self):
+        """Closes the session and every pooled connection"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+        self._session = None
+        self._loop = None
+
+
+# connection pool shared by the scrapers and the cache proxy
+shared_client = HTTPClient(
+    limit=100,
+    limit_per_host=8,
+    keepalive_timeout=30,
+    ttl_dns_cache=300,
+    timeout=aiohttp.ClientTimeout(total=60, sock_connect=10, sock_read=30),
+    headers={"User-Agent": DEFAULT_USER_AGENT},
+)